@@ -0,0 +1,131 @@
+import asyncio
+
+DEFAULT_SKIP_OFFSET = 5.0  # Seconds into an ad its skip button shows up, when the event doesn't say
+SKIP_MARGIN = 0.25  # A skip sent before the button shows up is ignored by the TV
+
+
+def _seconds(value, default=None):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+# Follows the ads of a device and skips them as soon as they can be skipped, instead of waiting for the
+# event saying so (and the round trip after it). adPlaying tells whether the ad is skippable, where it is
+# (currentTime) and how long until it can be skipped (skipTimeRemaining), the skip is timed for when its
+# button shows up. It's cancelled when the ad is paused (and timed again when it resumes), ends or is
+# skipped. An event saying the ad can be skipped skips it right away if that wasn't done yet, every ad
+# gets a single skip. Keeps score of how long skippable ads played after they could have been skipped
+class AdBreakTracker:
+    def __init__(self, skip, spawn):
+        self.skip = skip  # Coroutine function skipping the ad
+        self.spawn = spawn  # Runs a coroutine in the background
+        self.timer = None
+        self.ad_id = None
+        self.skippable = False
+        self.skip_offset = DEFAULT_SKIP_OFFSET  # Seconds into the current ad it can be skipped
+        self.skippable_at = None  # Loop time the current ad became skippable
+        self.skipped = False  # A skip was sent for the current ad
+        self.ads = 0
+        self.predicted_skips = 0
+        self.reactive_skips = 0
+        self.cancelled = 0
+        self.skippable_ads = 0
+        self.skippable_seconds = 0.0  # Played after the ad could be skipped, every ad
+
+    def ad_playing(self, data):
+        """adPlaying"""
+        ad_id = data.get("adVideoId") or data.get("contentVideoId")
+        if ad_id != self.ad_id:
+            self.__ad_ended()
+            self.ad_id = ad_id
+            self.ads += 1
+            self.skippable = data.get("isSkippable") == "true"
+            self.skip_offset = DEFAULT_SKIP_OFFSET
+        remaining = _seconds(data.get("skipTimeRemaining"))
+        if remaining is not None:  # From currentTime
+            self.skip_offset = _seconds(data.get("currentTime"), 0.0) + remaining
+        self.__position(data, data.get("adState", "1") == "1")
+
+    def ad_state_changed(self, data):
+        """onAdStateChange"""
+        if data.get("adState") == "0":
+            self.__ad_ended()
+            return
+        self.__position(data, data.get("adState") == "1")
+
+    def content_playing(self):
+        """The video is playing (again), no ad is"""
+        self.__ad_ended()
+
+    def skip_enabled(self):
+        """An event said the ad can be skipped"""
+        now = asyncio.get_running_loop().time()
+        if self.skippable_at is None or self.skippable_at > now:
+            self.skippable_at = now
+        if not self.skipped:
+            self.reactive_skips += 1
+            self.__skip()
+
+    def __position(self, data, playing):
+        if self.__cancel() and not playing:
+            self.cancelled += 1
+        if data.get("isSkipEnabled") == "true":
+            self.skip_enabled()
+            return
+        if not (self.skippable and playing) or self.skipped:
+            return
+        loop = asyncio.get_running_loop()
+        position = _seconds(data.get("currentTime"), 0.0)
+        skippable_in = max(self.skip_offset - position, 0.0)
+        self.skippable_at = loop.time() + skippable_in
+        self.timer = loop.call_at(
+            self.skippable_at + SKIP_MARGIN, self.__predicted_skip
+        )
+
+    def __predicted_skip(self):
+        self.timer = None
+        if not self.skipped:
+            self.predicted_skips += 1
+            self.__skip()
+
+    def __skip(self):
+        self.skipped = True
+        self.__cancel()
+        self.spawn(self.skip())
+
+    def __cancel(self):
+        """True if a skip was scheduled"""
+        if self.timer is None:
+            return False
+        self.timer.cancel()
+        self.timer = None
+        return True
+
+    def __ad_ended(self):
+        if self.__cancel():
+            self.cancelled += 1
+        if self.ad_id is None:
+            return
+        if self.skippable_at is not None:
+            now = asyncio.get_running_loop().time()
+            self.skippable_ads += 1
+            self.skippable_seconds += max(now - self.skippable_at, 0.0)
+        self.ad_id = None
+        self.skippable = False
+        self.skippable_at = None
+        self.skipped = False
+
+    def stats(self):
+        return {
+            "ads": self.ads,
+            "predicted_skips": self.predicted_skips,
+            "reactive_skips": self.reactive_skips,
+            "cancelled": self.cancelled,
+            "mean_skippable_seconds": (
+                round(self.skippable_seconds / self.skippable_ads, 3)
+                if self.skippable_ads
+                else None
+            ),
+        }
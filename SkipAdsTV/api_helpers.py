@@ -1,11 +1,28 @@
+import asyncio
 import html
+import logging
+import os
+import time
 from hashlib import sha256
 
-from aiohttp import ClientSession
+from aiohttp import ClientSession, ClientTimeout
 from cache import AsyncLRU
+from cache.lru import LRU
 
-from . import constants, dial_client
+from . import constants
+from .background_tasks import BackgroundTasks
 from .conditional_ttl_cache import AsyncConditionalTTL
+from .fetch_scheduler import BACKGROUND, NEXT_UP, FetchScheduler, fetch_priority
+from .persistent_cache import PersistentLRU
+from .queue_prefetch import RequestBudget
+from .segment_buckets import BucketCache, PrefixLength, SegmentBucket
+from .sponsorblock_client import SponsorBlockClient, SponsorBlockUnavailable
+from .ttl_policy import TTL_POLICIES
+from .viewed_reports import ViewedReportQueue
+
+logger = logging.getLogger("SkipAdsTV")
+SEARCH_CACHE_TTL = 60 * 60 * 24  # Subscriber counts of channel search results are refreshed daily
+PLAYLIST_CACHE_TTL = 60 * 10
 
 
 def list_to_tuple(function):
@@ -18,15 +35,138 @@ def list_to_tuple(function):
     return wrapper
 
 
-# Class that handles all the api calls and their cache
+# Resolves video ids to channel ids with the YouTube Data API. Every id requested within `window` seconds
+# (up to 50, the most the videos endpoint takes) is resolved in a single videos?id=a,b,c call.
+# A video's channel never changes, so the results are kept for good in `channel_ids` (video id -> channel id).
+# A request that fails or takes more than `timeout` seconds leaves the channels unknown (not whitelisted)
+class ChannelResolver:
+    def __init__(
+        self,
+        web_session: ClientSession,
+        apikey,
+        channel_ids,
+        window=0.05,
+        batch_size=50,
+        timeout=5.0,
+    ) -> None:
+        self.web_session = web_session
+        self.apikey = apikey
+        self.window = window
+        self.batch_size = batch_size
+        self.timeout = ClientTimeout(total=timeout)
+        self.channel_ids = channel_ids
+        self.futures = {}  # video id -> future, for the ids waiting on or in a request
+        self.pending = []  # video ids waiting for the next request
+        self.flush_handle = None
+        self.requests = BackgroundTasks(logger)
+
+    async def get_channel_id(self, vid_id):
+        if vid_id in self.channel_ids:
+            return self.channel_ids[vid_id]
+        future = self.futures.get(vid_id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self.futures[vid_id] = loop.create_future()
+            self.pending.append(vid_id)
+            if len(self.pending) >= self.batch_size:
+                self.__flush()
+            elif self.flush_handle is None:
+                self.flush_handle = loop.call_later(self.window, self.__flush)
+        return await asyncio.shield(future)
+
+    def __flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = (
+            self.pending[: self.batch_size],
+            self.pending[self.batch_size :],
+        )
+        if self.pending:
+            self.flush_handle = asyncio.get_running_loop().call_soon(self.__flush)
+        # Required: the futures of the batch are only resolved by it
+        self.requests.spawn(self.__resolve(batch), required=True)
+
+    async def __resolve(self, batch):
+        channel_ids = {}
+        params = {
+            "id": ",".join(batch),
+            "key": self.apikey,
+            "part": "snippet",
+            "fields": "items(id,snippet/channelId)",
+            "maxResults": str(len(batch)),
+        }
+        url = constants.Youtube_api + "videos"
+        try:
+            async with self.web_session.get(
+                url, params=params, timeout=self.timeout
+            ) as resp:
+                data = await resp.json()
+            for i in data.get("items", []):
+                channel_ids[i["id"]] = i["snippet"]["channelId"]
+        except Exception as e:
+            logger.error("Error getting the channel of videos %s: %r", batch, e)
+        for vid_id in batch:
+            channel_id = channel_ids.get(vid_id)
+            if channel_id:  # Don't remember failures
+                self.channel_ids[vid_id] = channel_id
+            self.futures.pop(vid_id).set_result(channel_id)
+
+
+# Class that handles all the api calls and their cache. `clock` (seconds) is the time the caches, the
+# prefetch budget and the viewed reports' dedupe go by, tools/replay.py replaces it with its virtual one
 class ApiHelper:
-    def __init__(self, config, web_session: ClientSession) -> None:
+    def __init__(
+        self, config, web_session: ClientSession, clock=time.monotonic
+    ) -> None:
+        self.clock = clock
         self.apikey = config.apikey
         self.skip_categories = config.skip_categories
-        self.channel_whitelist = config.channel_whitelist
+        self.whitelisted_channels = {i["id"] for i in config.channel_whitelist}
         self.skip_count_tracking = config.skip_count_tracking
         self.web_session = web_session
         self.num_devices = len(config.devices)
+        self.data_dir = config.data_dir
+        self.sponsorblock = SponsorBlockClient(
+            web_session,
+            config.sponsorblock_apis,
+            timeout=config.sponsorblock_timeout,
+            hedge=config.sponsorblock_hedge,
+        )
+        self.prefix_length = PrefixLength(
+            config.hash_prefix_length,
+            adaptive=config.hash_prefix_adaptive,
+            max_length=config.hash_prefix_max_length,
+        )
+        # Requests for the playing video go before prefetches
+        self.segment_fetches = FetchScheduler(config.sponsorblock_concurrency)
+        self.ttl_policy = TTL_POLICIES[config.segment_ttl_policy]()
+        # Refreshing a video's segments has to reach SponsorBlock, a bucket can't outlive the shortest TTL
+        self.segment_buckets = BucketCache(
+            time_to_live=self.ttl_policy.min_ttl, clock=clock
+        )
+        # Video id -> (digest of its SponsorBlock entry, process_segments result)
+        self.processed_segments = LRU(maxsize=64)
+        # SponsorBlock requests the playlist and queue prefetches of every device may make
+        self.prefetch_budget = RequestBudget(config.queue_prefetch_budget, clock)
+        self.playlists = LRU(maxsize=32)  # List id -> (fetched at, video ids)
+        self.channel_ids = PersistentLRU(
+            self.__data_file("channel_cache.json"), maxsize=20000
+        )
+        self.channel_resolver = ChannelResolver(
+            web_session, self.apikey, self.channel_ids
+        )
+        self.channel_searches = PersistentLRU(
+            self.__data_file("search_cache.json"), maxsize=200
+        )
+        self.viewed_reports = ViewedReportQueue(
+            self.sponsorblock, self.__data_file("viewed_queue.json"), clock=clock
+        )
+        self.segments_cache.clock = clock
+
+    def __data_file(self, name):
+        """Path of a file in the data directory, None (don't persist) without one"""
+        return os.path.join(self.data_dir, name) if self.data_dir else None
 
     # Not used anymore, maybe it can stay here a little longer
     @AsyncLRU(maxsize=10)
@@ -48,31 +188,21 @@ class ApiHelper:
                 return i["id"]["videoId"], i["snippet"]["channelId"]
         return
 
-    @AsyncLRU(maxsize=100)
     async def is_whitelisted(self, vid_id):
-        if self.apikey and self.channel_whitelist:
-            channel_id = await self.__get_channel_id(vid_id)
-            # check if channel id is in whitelist
-            for i in self.channel_whitelist:
-                if i["id"] == channel_id:
-                    return True
+        if self.apikey and self.whitelisted_channels:
+            channel_id = await self.channel_resolver.get_channel_id(vid_id)
+            return channel_id in self.whitelisted_channels
         return False
 
-    async def __get_channel_id(self, vid_id):
-        params = {"id": vid_id, "key": self.apikey, "part": "snippet"}
-        url = constants.Youtube_api + "videos"
-        async with self.web_session.get(url, params=params) as resp:
-            data = await resp.json()
-
-        if "error" in data:
-            return
-        data = data["items"][0]
-        if data["kind"] != "youtube#video":
-            return
-        return data["snippet"]["channelId"]
-
-    @AsyncLRU(maxsize=10)
     async def search_channels(self, channel):
+        """Searches channels by name, returns up to 5 (channel id, name, subscriber count) tuples.
+        Takes two requests (search, then the statistics of every result at once), and the results of
+        each query are kept in data_dir for a day"""
+        query = channel.strip().lower()
+        if query in self.channel_searches:
+            searched_at, channels = self.channel_searches[query]
+            if time.time() - searched_at < SEARCH_CACHE_TTL:
+                return [tuple(i) for i in channels]
         channels = []
         params = {
             "q": channel,
@@ -84,69 +214,208 @@ class ApiHelper:
         url = constants.Youtube_api + "search"
         async with self.web_session.get(url, params=params) as resp:
             data = await resp.json()
-        if "error" in data:
+        if "error" in data or not data.get("items"):
             return channels
 
+        # Get the subscription number of every channel found in one request
+        channel_ids = [i["snippet"]["channelId"] for i in data["items"]]
+        params = {
+            "id": ",".join(channel_ids),
+            "key": self.apikey,
+            "part": "statistics",
+            "fields": "items(id,statistics(subscriberCount,hiddenSubscriberCount))",
+        }
+        url = constants.Youtube_api + "channels"
+        async with self.web_session.get(url, params=params) as resp:
+            channel_data = await resp.json()
+        statistics = {
+            i["id"]: i["statistics"] for i in channel_data.get("items", [])
+        }
+
         for i in data["items"]:
-            # Get channel subscription number
-            params = {
-                "id": i["snippet"]["channelId"],
-                "key": self.apikey,
-                "part": "statistics",
-            }
-            url = constants.Youtube_api + "channels"
-            async with self.web_session.get(url, params=params) as resp:
-                channel_data = await resp.json()
-
-            if channel_data["items"][0]["statistics"]["hiddenSubscriberCount"]:
+            channel_statistics = statistics.get(i["snippet"]["channelId"])
+            if channel_statistics is None:
+                sub_count = "Unknown"
+            elif channel_statistics.get("hiddenSubscriberCount"):
                 sub_count = "Hidden"
             else:
-                sub_count = int(
-                    channel_data["items"][0]["statistics"]["subscriberCount"]
-                )
+                sub_count = int(channel_statistics["subscriberCount"])
                 sub_count = format(sub_count, "_")
 
             channels.append(
                 (i["snippet"]["channelId"], i["snippet"]["channelTitle"], sub_count)
             )
+        self.channel_searches[query] = [time.time(), channels]
         return channels
 
-    @list_to_tuple  # Convert list to tuple so it can be used as a key in the cache
-    @AsyncConditionalTTL(
-        time_to_live=300, maxsize=10
-    )  # 5 minutes for non-locked segments
     async def get_segments(self, vid_id):
-        if await self.is_whitelisted(vid_id):
+        try:
+            return await self.__get_cached_segments(vid_id)
+        except SponsorBlockUnavailable as e:
+            # Nothing cached to fall back to either
+            logger.error("Error getting segments for video %s: %s", vid_id, e)
+            return []
+
+    async def prefetch_segments(self, vid_id, priority=NEXT_UP):
+        """get_segments for a video that isn't playing yet, its requests wait for the ones that are"""
+        token = fetch_priority.set(priority)
+        try:
+            await self.get_segments(vid_id)
+        finally:
+            fetch_priority.reset(token)
+
+    async def prefetch_queue(self, vid_ids):
+        """Warms the segments of the next videos of a playlist or queue, the first one at NEXT_UP priority
+        and the rest in the background. Only the requests it takes (one per prefix that isn't cached, the
+        videos sharing one share the request) count against the prefetch budget, the videos past it are
+        left out"""
+        prefixes = set()
+        prefetches = []
+        for i, vid_id in enumerate(vid_ids):
+            vid_hash = sha256(vid_id.encode("utf-8")).hexdigest()
+            if vid_hash not in self.segment_buckets:
+                prefix = vid_hash[: self.prefix_length.length]
+                if prefix not in prefixes:
+                    if not self.prefetch_budget.take():
+                        break
+                    prefixes.add(prefix)
+            prefetches.append(
+                self.prefetch_segments(vid_id, NEXT_UP if i == 0 else BACKGROUND)
+            )
+        await asyncio.gather(*prefetches)
+
+    async def get_playlist_items(self, list_id, count):
+        """The first `count` (or more) video ids of a playlist, from the YouTube Data API. Queues made on
+        the TV (RQ...) aren't public, and without an API key nothing can be fetched: those are empty"""
+        if not self.apikey or list_id.startswith("RQ"):
+            return []
+        cached = self.playlists.get(list_id)
+        if cached is not None and time.time() - cached[0] < PLAYLIST_CACHE_TTL:
+            fetched_at, video_ids, complete = cached
+            if complete or len(video_ids) >= count:
+                return video_ids
+        video_ids = []
+        complete = False  # Got to the last page
+        params = {
+            "playlistId": list_id,
+            "key": self.apikey,
+            "part": "contentDetails",
+            "fields": "nextPageToken,items/contentDetails/videoId",
+            "maxResults": "50",
+        }
+        url = constants.Youtube_api + "playlistItems"
+        try:
+            while len(video_ids) < count:
+                async with self.web_session.get(url, params=params) as resp:
+                    data = await resp.json()
+                if "error" in data:  # Private or deleted, no point asking again soon
+                    complete = True
+                    break
+                video_ids.extend(
+                    i["contentDetails"]["videoId"] for i in data.get("items", [])
+                )
+                if "nextPageToken" not in data:
+                    complete = True
+                    break
+                params["pageToken"] = data["nextPageToken"]
+        except Exception as e:
+            logger.error("Error getting the videos of playlist %s: %r", list_id, e)
+            return video_ids
+        self.playlists[list_id] = (time.time(), video_ids, complete)
+        return video_ids
+
+    # Keyed on the video id only (skip_args=1): the ApiHelper's attributes change as its caches fill up, so
+    # they can't be part of the key. There is a single ApiHelper
+    segments_cache = AsyncConditionalTTL(
+        time_to_live=300, maxsize=10, skip_args=1, stale_on=(SponsorBlockUnavailable,)
+    )  # 5 minutes for non-locked segments, expired segments are used while SponsorBlock is down
+
+    @list_to_tuple  # Convert list to tuple so it can be used as a key in the cache
+    @segments_cache
+    async def __get_cached_segments(self, vid_id):
+        if not (self.apikey and self.whitelisted_channels):
+            return await self.__get_segments(vid_id)
+        # Check the whitelist while the segments are being fetched, instead of before
+        whitelisted, segments = await asyncio.gather(
+            self.is_whitelisted(vid_id), self.__get_segments(vid_id)
+        )
+        if whitelisted:
             return (
                 [],
                 True,
             )  # Return empty list and True to indicate that the cache should last forever
-        vid_id_hashed = sha256(vid_id.encode("utf-8")).hexdigest()[
-            :4
-        ]  # Hashes video id and gets the first 4 characters
+        return segments
+
+    async def __get_segments(self, vid_id):
+        vid_hash = sha256(vid_id.encode("utf-8")).hexdigest()
+        bucket = self.segment_buckets.get(vid_hash)
+        # Whether this call's job made the request. The ones that joined it (e.g. a prefetch and the
+        # playing video at once) would count the same refresh again
+        fetched = False
+        if bucket is None:
+            prefix = vid_hash[: self.prefix_length.length]
+
+            def get_bucket():
+                nonlocal fetched
+                fetched = True
+                return self.__get_bucket(vid_id, prefix)
+
+            bucket = await self.segment_fetches.run(prefix, get_bucket)
+            if bucket is None:
+                return [], True
+        # Only the entry of this video gets decoded, not the whole response
+        digest = bucket.digest(vid_id)
+        entry = bucket.get(vid_id)
+        if digest is None:
+            segments, locked = self.process_segments({})
+        else:
+            # When an expired entry is refreshed and its segments didn't change, the result is reused
+            processed = self.processed_segments.get(vid_id)
+            if processed is not None and processed[0] == digest:
+                self.processed_segments.move_to_end(vid_id)
+                segments, locked = processed[1]
+            else:
+                segments, locked = self.process_segments(entry)
+                self.processed_segments[vid_id] = (digest, (segments, locked))
+        return segments, self.ttl_policy.ttl(vid_id, entry, digest, locked, fetched)
+
+    async def __get_bucket(self, vid_id, vid_id_hashed):
         params = {
             "category": self.skip_categories,
             "actionType": constants.SponsorBlock_actiontype,
             "service": constants.SponsorBlock_service,
         }
         headers = {"Accept": "application/json"}
-        url = constants.SponsorBlock_api + "skipSegments/" + vid_id_hashed
-        async with self.web_session.get(
-            url, headers=headers, params=params
-        ) as response:
-            response_json = await response.json()
-        if response.status != 200:
-            response_text = await response.text()
-            print(
-                f"Error getting segments for video {vid_id}, hashed as {vid_id_hashed}."
-                f" Code: {response.status} - {response_text}"
+        stale = self.segment_buckets.get_stale(vid_id_hashed)
+        if stale is not None:  # Revalidate it instead of downloading it again
+            headers.update(stale.validators())
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        response = await self.sponsorblock.request(
+            "GET", "skipSegments/" + vid_id_hashed, headers=headers, params=params
+        )
+        if response.status == 304 and stale is not None:  # Not modified
+            bucket = stale
+        elif response.status == 404:  # No video with this prefix has segments
+            bucket = SegmentBucket(b"[]")
+        elif response.status == 200:
+            bucket = SegmentBucket(
+                response.body,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
             )
-            return [], True
-        for i in response_json:
-            if str(i["videoID"]) == str(vid_id):
-                response_json = i
-                break
-        return self.process_segments(response_json)
+        else:
+            logger.error(
+                "Error getting segments for video %s, hashed as %s. Code: %s - %s",
+                vid_id,
+                vid_id_hashed,
+                response.status,
+                response.text(),
+            )
+            return None
+        self.prefix_length.record(len(bucket.body), loop.time() - start)
+        self.segment_buckets.put(vid_id_hashed, bucket)
+        return bucket
 
     @staticmethod
     def process_segments(response):
@@ -196,17 +465,89 @@ class ApiHelper:
             pass
         return segments, ignore_ttl
 
-    async def mark_viewed_segments(self, uuids):
+    def mark_viewed_segments(self, uuids):
         """Marks the segments as viewed in the SponsorBlock API, if skip_count_tracking is enabled.
-        Lets the contributor know that someone skipped the segment (thanks)"""
+        Lets the contributor know that someone skipped the segment (thanks).
+        Only queues the reports, ViewedReportQueue sends them in the background"""
         if self.skip_count_tracking:
-            for i in uuids:
-                url = constants.SponsorBlock_api + "viewedVideoSponsorTime/"
-                params = {"UUID": i}
-                await self.web_session.post(url, params=params)
+            self.viewed_reports.put(uuids)
+
+    def update(self, config, changed):
+        """Applies a reloaded config (`changed` are the names of the options that changed). Only the cached
+        segments that depend on what changed are dropped"""
+        self.num_devices = len(config.devices)
+        self.skip_count_tracking = config.skip_count_tracking
+        if "skip_categories" in changed:  # Every response depends on them
+            self.skip_categories = config.skip_categories
+            self.segments_cache.invalidate()
+            self.segment_buckets.clear()
+            self.processed_segments.clear()
+        if "apikey" in changed or "channel_whitelist" in changed:
+            whitelisted_channels = {i["id"] for i in config.channel_whitelist}
+            toggled = whitelisted_channels ^ self.whitelisted_channels
+            if "apikey" in changed:
+                self.apikey = config.apikey
+                self.channel_resolver.apikey = config.apikey
+                self.segments_cache.invalidate()
+            else:  # Only the videos of channels added or removed, or whose channel is unknown
+                self.segments_cache.invalidate(
+                    lambda vid_id: self.channel_ids.get(vid_id) in toggled
+                    or vid_id not in self.channel_ids
+                )
+            self.whitelisted_channels = whitelisted_channels
+        if {"sponsorblock_apis", "sponsorblock_timeout", "sponsorblock_hedge"} & changed:
+            self.sponsorblock = SponsorBlockClient(
+                self.web_session,
+                config.sponsorblock_apis,
+                timeout=config.sponsorblock_timeout,
+                hedge=config.sponsorblock_hedge,
+            )
+            self.viewed_reports.sponsorblock = self.sponsorblock
+        self.segment_fetches.concurrency = config.sponsorblock_concurrency
+        # Buckets are looked up under every prefix length, the cached ones stay valid
+        self.prefix_length.length = config.hash_prefix_length
+        self.prefix_length.adaptive = config.hash_prefix_adaptive
+        self.prefix_length.max_length = min(
+            max(config.hash_prefix_max_length, config.hash_prefix_length),
+            self.prefix_length.API_MAX_LENGTH,
+        )
+        if "queue_prefetch_budget" in changed:
+            self.prefetch_budget = RequestBudget(
+                config.queue_prefetch_budget, self.clock
+            )
+        if "segment_ttl_policy" in changed:  # Cached entries keep the TTL they got
+            self.ttl_policy = TTL_POLICIES[config.segment_ttl_policy]()
+            self.segment_buckets.time_to_live = self.ttl_policy.min_ttl
+
+    def stats(self):
+        return {
+            "sponsorblock": self.sponsorblock.stats(),
+            "hash_prefix": self.prefix_length.stats(),
+            "segment_fetches": self.segment_fetches.stats(),
+            "segment_buckets": {
+                "buckets": len(self.segment_buckets.buckets),
+                "hits": self.segment_buckets.hits,
+                "misses": self.segment_buckets.misses,
+            },
+            "segment_ttl": self.ttl_policy.stats(),
+            "queue_prefetch": self.prefetch_budget.stats(),
+            "viewed_reports": {
+                "pending": len(self.viewed_reports.pending),
+                "sent": self.viewed_reports.sent,
+                "dropped": self.viewed_reports.dropped,
+            },
+        }
+
+    def save(self):
+        """Writes the persistent caches to the data directory"""
+        self.channel_ids.save()
+        self.channel_searches.save()
+        self.viewed_reports.save()
 
     async def discover_youtube_devices_dial(self):
         """Discovers YouTube devices using DIAL"""
+        from . import dial_client  # ssdp and xmltodict are only needed for setup
+
         dial_screens = await dial_client.discover(self.web_session)
         # print(dial_screens)
         return dial_screens
@@ -0,0 +1,55 @@
+import asyncio
+
+
+# The fire-and-forget tasks of a device (commands sent in reaction to lounge events, segment prefetches,
+# skips). They are kept referenced until they finish, their errors are logged instead of being lost, and
+# at most `limit` of them are outstanding: a device that floods events gets its newest ones dropped
+# rather than slowing everything down
+class BackgroundTasks:
+    def __init__(self, logger, limit=32):
+        self.logger = logger
+        self.limit = limit
+        self.tasks = set()
+        self.dropped = 0
+        self.errors = 0
+
+    def spawn(self, coro, required=False):
+        """Runs coro in a task, returns the task (None if it was dropped). Required ones are never dropped"""
+        if not required and len(self.tasks) >= self.limit:
+            coro.close()
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                self.logger.warning(
+                    "Too many background tasks (%d), %d dropped so far",
+                    len(self.tasks),
+                    self.dropped,
+                )
+            return None
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.__done)
+        return task
+
+    def __done(self, task):
+        self.tasks.discard(task)
+        if task.cancelled():
+            return
+        if (error := task.exception()) is not None:
+            self.errors += 1
+            self.logger.error(
+                "Background task %s failed: %r",
+                getattr(task.get_coro(), "__qualname__", task.get_name()),
+                error,
+                exc_info=error,
+            )
+
+    def cancel_all(self):
+        for task in list(self.tasks):
+            task.cancel()
+
+    def stats(self):
+        return {
+            "outstanding": len(self.tasks),
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
@@ -1,16 +1,15 @@
-import datetime
+import time
 
 from cache.key import KEY
 from cache.lru import LRU
 
 class AsyncConditionalTTL:
     class _TTL(LRU):
-        def __init__(self, time_to_live, maxsize):
+        def __init__(self, time_to_live, maxsize, clock):
             super().__init__(maxsize=maxsize)
 
-            self.time_to_live = (
-                datetime.timedelta(seconds=time_to_live) if time_to_live else None
-            )
+            self.time_to_live = time_to_live or None
+            self.clock = clock
 
             self.maxsize = maxsize
 
@@ -18,33 +17,65 @@ class AsyncConditionalTTL:
             if key not in self.keys():
                 return False
             key_expiration = super().__getitem__(key)[1]
-            if key_expiration and key_expiration < datetime.datetime.now():
-                del self[key]
-                return False
+            if key_expiration and key_expiration < self.clock():
+                return False  # Expired, but kept (until evicted) in case it has to be served stale
             return True
 
         def __getitem__(self, key):
             value = super().__getitem__(key)[0]
             return value
 
+        def get_stale(self, key):
+            return super().__getitem__(key)[0]
+
         def __setitem__(self, key, value):
             value, ignore_ttl = value  # unpack tuple
-            ttl_value = (
-                (datetime.datetime.now() + self.time_to_live)
-                if (self.time_to_live and not ignore_ttl)
-                else None
-            )  # ignore ttl if ignore_ttl is True
+            if ignore_ttl is True:
+                ttl_value = None  # ignore ttl if ignore_ttl is True
+            elif ignore_ttl is False:
+                ttl_value = (
+                    (self.clock() + self.time_to_live) if self.time_to_live else None
+                )
+            else:  # A ttl of its own, in seconds
+                ttl_value = self.clock() + ignore_ttl
             super().__setitem__(key, (value, ttl_value))
 
-    def __init__(self, time_to_live=60, maxsize=1024, skip_args: int = 0):
+    def __init__(
+        self,
+        time_to_live=60,
+        maxsize=1024,
+        skip_args: int = 0,
+        stale_on=(),
+        stale_ttl=30,
+        clock=time.monotonic,
+    ):
         """
 
         :param time_to_live: Use time_to_live as None for non expiring cache
         :param maxsize: Use maxsize as None for unlimited size cache
         :param skip_args: Use `1` to skip first arg of func in determining cache key
+        :param stale_on: Exception types on which an expired value is served (for `stale_ttl` more
+            seconds) instead of raising
+        :param clock: Returns the current time in seconds, for the expiry of the entries
         """
-        self.ttl = self._TTL(time_to_live=time_to_live, maxsize=maxsize)
+        self.ttl = self._TTL(time_to_live=time_to_live, maxsize=maxsize, clock=clock)
         self.skip_args = skip_args
+        self.stale_on = tuple(stale_on)
+        self.stale_ttl = stale_ttl
+
+    @property
+    def clock(self):
+        return self.ttl.clock
+
+    @clock.setter
+    def clock(self, clock):
+        self.ttl.clock = clock
+
+    def invalidate(self, predicate=None):
+        """Drops the entries whose call arguments (after the skipped ones) match predicate, or all of them"""
+        for key in list(self.ttl.keys()):
+            if predicate is None or predicate(*key.args[0]):
+                del self.ttl[key]
 
     def __call__(self, func):
         async def wrapper(*args, **kwargs):
@@ -52,7 +83,12 @@ class AsyncConditionalTTL:
             if key in self.ttl:
                 val = self.ttl[key]
             else:
-                self.ttl[key] = await func(*args, **kwargs)
+                try:
+                    self.ttl[key] = await func(*args, **kwargs)
+                except self.stale_on:
+                    if key not in self.ttl.keys():
+                        raise
+                    self.ttl[key] = (self.ttl.get_stale(key), self.stale_ttl)
                 val = self.ttl[key]
 
             return val
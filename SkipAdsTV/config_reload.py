@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import os
+
+from . import ytlounge
+from .helpers import Config
+
+logger = logging.getLogger("SkipAdsTV")
+
+# Options only read when the daemon starts, changing them takes a restart
+RESTART_REQUIRED = {
+    "event_loop",
+    "log_format",
+    "http_connection_limit",
+    "http_limit_per_host",
+    "http_keepalive_timeout",
+    "dns_cache_ttl",
+    "max_background_tasks",
+    "slow_callback_threshold",
+}
+
+
+# Polls config.json's mtime and applies its changes to the running daemon: devices that were added or
+# removed are started or stopped, offset and name changes are applied in place, and ApiHelper updates its
+# settings and drops only the cached segments that depend on them. Devices that didn't change keep their
+# lounge connection. A config that doesn't load or validate is ignored (the running one stays). Changes to
+# the options in RESTART_REQUIRED are only logged
+class ConfigReloader:
+    def __init__(self, config, api_helper, devices, interval=5):
+        self.config = config
+        self.api_helper = api_helper
+        self.devices = devices
+        self.interval = interval
+
+    def mtime(self):
+        try:
+            return os.stat(self.config.config_file).st_mtime_ns
+        except OSError:
+            return None
+
+    async def run(self):
+        mtime = self.mtime()
+        while True:
+            await asyncio.sleep(self.interval)
+            current = self.mtime()
+            if current is None or current == mtime:
+                continue
+            mtime = current
+            try:
+                await self.reload()
+            except Exception:  # Tried again when the file changes
+                logger.exception("Could not reload the config file")
+
+    async def reload(self):
+        try:
+            config = Config(self.config.data_dir)
+            if not config.devices or hasattr(config, "atvs"):
+                raise ValueError("No devices found")
+            config.validate()
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.warning("Not reloading the config file: %s", e)
+            return
+        old_devices = {i.screen_id: vars(i) for i in self.config.devices}
+        new_devices = {i.screen_id: i for i in config.devices}
+        changed = {
+            key
+            for key, value in vars(config).items()
+            if key != "devices" and value != getattr(self.config, key, None)
+        }
+        vars(self.config).update(vars(config))
+
+        self.api_helper.update(self.config, changed)
+        if "lounge_api" in changed:
+            ytlounge.set_api_base(self.config.lounge_api)
+        if "auto_play" in changed:
+            self.devices.set_auto_play(self.config.auto_play)
+        removed = old_devices.keys() - new_devices.keys()
+        for screen_id in removed:
+            await self.devices.stop(screen_id)
+        added = updated = 0
+        for screen_id, device in new_devices.items():
+            if screen_id not in old_devices:
+                self.devices.start(device)
+                added += 1
+            elif vars(device) != old_devices[screen_id]:
+                self.devices.update(device)
+                updated += 1
+        logger.info(
+            "Config reloaded: %s changed, %d devices added, %d removed, %d updated",
+            ", ".join(sorted(changed)) or "no settings",
+            added,
+            len(removed),
+            updated,
+        )
+        if changed & RESTART_REQUIRED:
+            logger.warning(
+                "Restart SkipAdsTV to apply the changes to %s",
+                ", ".join(sorted(changed & RESTART_REQUIRED)),
+            )
@@ -139,9 +139,7 @@ def main(config, debug: bool) -> None:
             if channel == "/exit":
                 break
 
-            task = loop.create_task(
-                api_helper.search_channels(channel, apikey, web_session)
-            )
+            task = loop.create_task(api_helper.search_channels(channel))
             loop.run_until_complete(task)
             results = task.result()
             if len(results) == 0:
@@ -169,6 +167,7 @@ def main(config, debug: bool) -> None:
             channel_info["id"] = results[int(choice)][0]
             channel_info["name"] = results[int(choice)][1]
             channel_whitelist.append(channel_info)
+        api_helper.save()
         # Close web session asynchronously
 
     config.channel_whitelist = channel_whitelist
@@ -2,7 +2,8 @@ userAgent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; Mediapartners-Google/2.1;
 SponsorBlock_service = "youtube"
 SponsorBlock_actiontype = "skip"
 
-SponsorBlock_api = "https://sponsor.ajay.app/api/"
+SponsorBlock_apis = ["https://sponsor.ajay.app/api/"]
+Lounge_api = "https://www.youtube.com/api/lounge"
 Youtube_api = "https://www.googleapis.com/youtube/v3/"
 
 skip_categories = (
@@ -0,0 +1,31 @@
+import json
+import time
+
+
+# Writes every lounge event seen by YtLoungeApi._process_event to a JSONL file, so it can be replayed offline
+# (see tools/replay.py). Each line is [timestamp, screen_id, event_id, event_type, args]
+class EventRecorder:
+    def __init__(self, path):
+        self.path = path
+        # Line buffered, so a crash or a kill doesn't lose the events that led to it
+        self.file = open(path, "a", encoding="utf-8", buffering=1)
+
+    def record(self, screen_id, event_id, event_type, args):
+        self.file.write(
+            json.dumps(
+                [round(time.time(), 3), screen_id, event_id, event_type, args],
+                separators=(",", ":"),
+            )
+            + "\n"
+        )
+
+    def close(self):
+        self.file.close()
+
+
+def read_events(path):
+    """Yields (timestamp, screen_id, event_id, event_type, args) tuples from a recording"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield tuple(json.loads(line))
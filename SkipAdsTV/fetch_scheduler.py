@@ -0,0 +1,113 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+from collections import deque
+
+# Priority classes, most urgent first
+NOW_PLAYING = 0
+NEXT_UP = 1
+BACKGROUND = 2
+PRIORITY_NAMES = {NOW_PLAYING: "now_playing", NEXT_UP: "next_up", BACKGROUND: "background"}
+
+# Priority of the fetches made by the current task. Unmarked fetches are for the video playing right now
+fetch_priority = contextvars.ContextVar("fetch_priority", default=NOW_PLAYING)
+
+
+class _Job:
+    def __init__(self, key, func, priority, future, queued_at):
+        self.key = key
+        self.func = func
+        self.priority = priority
+        self.future = future
+        self.queued_at = queued_at
+        self.started = False
+
+
+# Runs the requests to one upstream, at most `concurrency` at a time, most urgent first. Requests with the
+# same key share a single fetch: a prefetch that is still queued when the video starts playing gets
+# promoted to the playing video's priority instead of being requested twice
+class FetchScheduler:
+    def __init__(self, concurrency=4, wait_samples=200):
+        self.concurrency = concurrency
+        self.running = 0
+        self.queue = []  # Heap of (priority, sequence, job), promoted jobs leave a stale entry behind
+        self.jobs = {}  # key -> job, queued or running
+        self.sequence = itertools.count()
+        self.waits = {i: deque(maxlen=wait_samples) for i in PRIORITY_NAMES}
+        self.completed = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.joined = 0
+        self.promoted = 0
+
+    async def run(self, key, func, priority=None):
+        """Result of func() (a coroutine function), run when its turn comes"""
+        if priority is None:
+            priority = fetch_priority.get()
+        job = self.jobs.get(key)
+        if job is None:
+            loop = asyncio.get_running_loop()
+            job = self.jobs[key] = _Job(
+                key, func, priority, loop.create_future(), loop.time()
+            )
+            # Nobody may be waiting anymore when it fails (the caller was cancelled)
+            job.future.add_done_callback(
+                lambda future: future.cancelled() or future.exception()
+            )
+            heapq.heappush(self.queue, (priority, next(self.sequence), job))
+            self.__start_jobs()
+        else:
+            self.joined += 1
+            if priority < job.priority and not job.started:
+                job.priority = priority
+                heapq.heappush(self.queue, (priority, next(self.sequence), job))
+                self.promoted += 1
+        # A cancelled caller doesn't cancel the fetch, others may be waiting for it
+        return await asyncio.shield(job.future)
+
+    def __start_jobs(self):
+        loop = asyncio.get_running_loop()
+        while self.running < self.concurrency and self.queue:
+            priority, _, job = heapq.heappop(self.queue)
+            if job.started or priority != job.priority:  # Left behind by a promotion
+                continue
+            job.started = True
+            self.running += 1
+            self.waits[priority].append(loop.time() - job.queued_at)
+            loop.create_task(self.__execute(job))
+
+    async def __execute(self, job):
+        try:
+            job.future.set_result(await job.func())
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            job.future.set_exception(e)
+        finally:
+            self.running -= 1
+            self.completed[job.priority] += 1
+            del self.jobs[job.key]
+            self.__start_jobs()
+
+    def queue_depth(self):
+        return len(self.jobs) - self.running
+
+    def stats(self):
+        waits = {}
+        for priority, samples in self.waits.items():
+            if not samples:
+                continue
+            ordered = sorted(samples)
+            waits[PRIORITY_NAMES[priority]] = {
+                "mean_ms": round(sum(ordered) / len(ordered) * 1000, 1),
+                "p95_ms": round(ordered[int(len(ordered) * 0.95)] * 1000, 1),
+                "max_ms": round(ordered[-1] * 1000, 1),
+            }
+        return {
+            "queue_depth": self.queue_depth(),
+            "running": self.running,
+            "completed": {PRIORITY_NAMES[i]: j for i, j in self.completed.items()},
+            "joined": self.joined,
+            "promoted": self.promoted,
+            "wait": waits,
+        }
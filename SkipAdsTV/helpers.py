@@ -7,8 +7,22 @@ import time
 
 from appdirs import user_data_dir
 
-from . import config_setup, main, setup_wizard
-from .constants import config_file_blacklist_keys
+from .constants import Lounge_api, SponsorBlock_apis, config_file_blacklist_keys
+from .ttl_policy import TTL_POLICIES
+
+
+def save_json(path, data, **dump_kwargs):
+    """Writes data to a JSON file atomically (to a temporary file, then renamed over it), so a crash can't
+    leave it half written. Returns False, after printing why, if it couldn't be saved"""
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, **dump_kwargs)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not save {path}: {e}")
+        return False
+    return True
 
 
 class Device:
@@ -29,6 +43,23 @@ class Device:
             raise ValueError("No screen id found")
 
 
+# Numeric options: whether they take whole numbers only, and their smallest value
+NUMERIC_OPTIONS = {
+    "sponsorblock_timeout": (False, 0.1),
+    "sponsorblock_concurrency": (True, 1),
+    "hash_prefix_length": (True, 4),
+    "hash_prefix_max_length": (True, 4),
+    "queue_prefetch_count": (True, 0),
+    "queue_prefetch_budget": (True, 0),
+    "max_background_tasks": (True, 1),
+    "http_connection_limit": (True, 0),
+    "http_limit_per_host": (True, 0),
+    "http_keepalive_timeout": (False, 0),
+    "dns_cache_ttl": (False, 0),
+    "slow_callback_threshold": (False, 0),
+}
+
+
 class Config:
     def __init__(self, data_dir):
         self.data_dir = data_dir
@@ -42,6 +73,33 @@ class Config:
         self.mute_ads = True
         self.skip_ads = True
         self.auto_play = True
+        # SponsorBlock compatible servers, tried in order of health
+        self.sponsorblock_apis = list(SponsorBlock_apis)
+        self.sponsorblock_timeout = 5
+        self.sponsorblock_hedge = False
+        self.sponsorblock_concurrency = 4  # Requests in flight, the playing videos' go first
+        # Characters of the video id's hash sent to SponsorBlock. Adaptive mode changes it with the size of
+        # the responses, never above hash_prefix_max_length (fewer characters are more private)
+        self.hash_prefix_length = 4
+        self.hash_prefix_adaptive = False
+        self.hash_prefix_max_length = 5
+        # How long segments are cached: "adaptive" (from their votes and how often they change) or "fixed"
+        self.segment_ttl_policy = "adaptive"
+        # Videos of the playing playlist or queue whose segments are fetched ahead, and the SponsorBlock
+        # requests a minute (for every device) that may take
+        self.queue_prefetch_count = 3
+        self.queue_prefetch_budget = 30
+        self.lounge_api = Lounge_api
+        self.max_background_tasks = 32  # Per device, newer ones are dropped past it
+        self.log_format = "text"  # Or "json", one object per line
+        self.event_loop = "auto"  # "uvloop", "asyncio", or "auto": uvloop if it's installed
+        # HTTP connections: 0 for 2 per device + 50, none per host, seconds to keep idle ones
+        self.http_connection_limit = 0
+        self.http_limit_per_host = 0
+        self.http_keepalive_timeout = 30
+        self.dns_cache_ttl = 300
+        # Event loop stalls longer than this (seconds) are logged with their stack, 0 (off) by default
+        self.slow_callback_threshold = 0
         self.__load()
 
     def validate(self):
@@ -59,6 +117,23 @@ class Config:
             raise ValueError(
                 "No youtube API key found and channel whitelist is not empty"
             )
+        for name, (whole, minimum) in NUMERIC_OPTIONS.items():
+            value = getattr(self, name)
+            if (
+                isinstance(value, bool)
+                or not isinstance(value, int if whole else (int, float))
+                or value < minimum
+            ):
+                kind = "a whole number" if whole else "a number"
+                raise ValueError(f"{name} must be {kind}, at least {minimum}")
+        if not 4 <= self.hash_prefix_length <= 32 or self.hash_prefix_max_length > 32:
+            raise ValueError("The hash prefix length must be between 4 and 32")
+        if self.event_loop not in ("auto", "uvloop", "asyncio"):
+            raise ValueError('event_loop must be "auto", "uvloop" or "asyncio"')
+        if self.segment_ttl_policy not in TTL_POLICIES:
+            raise ValueError(
+                "segment_ttl_policy must be one of: " + ", ".join(TTL_POLICIES)
+            )
         if not self.skip_categories:
             self.skip_categories = ["Sponsor", "sponsor", "Self Promotion", "selfpromo", "Intro", "intro", "Outro", "outro", "Music Offtopic", "music_offtopic", "Interaction", "interaction", "Exclusive Access", "exclusive_access", "POI Highlight", "poi_highlight", "Preview", "preview", "Filler", "filler"]
             print("SkipAdsTV: Đã hoàn tất thiết lập")
@@ -110,16 +185,35 @@ def app_start():
         help="setup the program in the command line",
     )
     parser.add_argument("--debug", action="store_true", help="debug mode")
+    parser.add_argument(
+        "--record",
+        metavar="FILE",
+        help="record every lounge event to FILE (JSONL), for tools/replay.py",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="enable profiling: SIGUSR1 toggles cProfile, SIGUSR2 dumps tasks and"
+        " memory (written to the data directory)",
+    )
     args = parser.parse_args()
 
     config = Config(args.data_dir)
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
+    # The setup modules pull in textual, rich and the DIAL discovery stack, so they (and the daemon) are only
+    # imported when they are going to be used. tools/import_check.py keeps it that way
     if args.setup:  # Set up the config file graphically
+        from . import setup_wizard
+
         setup_wizard.main(config)
         sys.exit()
     if args.setup_cli:  # Set up the config file
+        from . import config_setup
+
         config_setup.main(config, args.debug)
     else:
         config.validate()
-        main.main(config, args.debug)
+        from . import main
+
+        main.main(config, args.debug, args.record, args.profile)
@@ -0,0 +1,100 @@
+import asyncio
+import json
+import logging
+import logging.handlers
+import queue
+import time
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+
+# Hands records to the writer thread, which formats and writes them instead of the event loop. Only the
+# message is resolved here, so arguments that change afterwards (the event dicts are mutated later) are
+# logged as they were. The traceback is still formatted on the writer thread
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+# Lets through at most `burst` records per logger and message template every `period` seconds. The next
+# record let through after a drop says how many similar ones were dropped
+class RateLimitFilter(logging.Filter):
+    def __init__(self, burst=20, period=10.0):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.windows = {}  # (logger, template) -> [window start, records, dropped]
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        window = self.windows.get(key)
+        if window is None or now - window[0] >= self.period:
+            dropped = window[2] if window else 0
+            if len(self.windows) > 1000:
+                self.windows.clear()
+            self.windows[key] = [now, 1, 0]
+            if dropped:
+                record.dropped = dropped
+            return True
+        if window[1] >= self.burst:
+            window[2] += 1
+            return False
+        window[1] += 1
+        return True
+
+
+# pyytlounge logs the cancellation of its requests as errors, devices are cancelled on every restart and exit
+def _not_cancelled(record):
+    return not (
+        record.exc_info and isinstance(record.exc_info[1], asyncio.CancelledError)
+    )
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        message = super().format(record)
+        dropped = getattr(record, "dropped", 0)
+        return f"{message} ({dropped} similar messages dropped)" if dropped else message
+
+
+# One compact JSON object per line
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "dropped", 0):
+            entry["dropped"] = record.dropped
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+
+
+def setup_logging(debug=False, log_format="text", stream=None):
+    """Sends the "SkipAdsTV" logger (and its per-device children) through a queue to a writer thread.
+    Returns the QueueListener, stop() it on exit to write what's left"""
+    logger = logging.getLogger("SkipAdsTV")
+    logger.setLevel(logging.DEBUG if debug else logging.INFO)
+    logger.propagate = False  # The root logger has a handler of its own in debug mode
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+    stream_handler = logging.StreamHandler(stream)
+    if log_format == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(TextFormatter(TEXT_FORMAT, "%H:%M:%S"))
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(_not_cancelled)
+    queue_handler.addFilter(RateLimitFilter())
+    logger.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    return listener
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+logger = logging.getLogger("SkipAdsTV")
+_ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
+
+
+def _task_name(task):
+    if task is None:
+        return None
+    coro = task.get_coro()
+    return f"{task.get_name()} ({getattr(coro, '__qualname__', None) or coro!r})"
+
+
+# Measures the event loop's lag all the time and catches what blocks it, without loop.set_debug.
+# A task on the loop wakes up every `interval` seconds and records how late it woke up. A watchdog thread,
+# waking up every `threshold` seconds, notices when it's late by more than that while the loop is still
+# blocked, and takes the stack of the loop's thread and the task that is running (None for a plain
+# callback). When the loop gets going again the stall is logged and kept for the metrics (without its
+# stack if it was over before the watchdog looked, which can happen below twice the threshold). Off by
+# default (slow_callback_threshold)
+class LoopMonitor:
+    def __init__(
+        self, interval=0.25, threshold=0.1, samples=1200, max_stalls=20, stack_depth=8
+    ):
+        self.interval = interval
+        self.threshold = threshold
+        self.stack_depth = stack_depth
+        self.lags = deque(maxlen=samples)  # Last 5 minutes with the defaults
+        self.stalls = deque(maxlen=max_stalls)
+        self.stall_count = 0
+        self.loop = None
+        self.loop_thread_id = None
+        self.beat = time.monotonic()
+        self.current_stall = None  # Caught by the watchdog, not over yet
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.task = None
+
+    def start(self, loop):
+        """Call from the thread that runs the loop"""
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.beat = time.monotonic()
+        self.task = loop.create_task(self.__tick())
+        threading.Thread(
+            target=self.__watch, name="SkipAdsTV-loop-watchdog", daemon=True
+        ).start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.task:
+            self.task.cancel()
+
+    async def __tick(self):
+        while True:
+            expected = self.loop.time() + self.interval
+            self.beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(self.loop.time() - expected, 0.0)
+            self.lags.append(lag)
+            if lag > self.threshold:
+                self.__stall_ended(lag)
+
+    def __watch(self):
+        while not self.stopped.wait(self.threshold):
+            blocked = time.monotonic() - self.beat - self.interval
+            if blocked < self.threshold or self.current_stall is not None:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            with self.lock:
+                self.current_stall = {
+                    "task": _task_name(asyncio.current_task(self.loop)),
+                    "stack": self.__stack(frame) if frame else [],
+                }
+
+    def __stack(self, frame):
+        # The loop's own frames are the same every time, only the ones it called into are useful
+        frames = [
+            i
+            for i in traceback.extract_stack(frame)
+            if not i.filename.startswith(_ASYNCIO_DIR)
+        ]
+        return [
+            line.rstrip()
+            for line in traceback.format_list(frames[-self.stack_depth :])
+        ]
+
+    def __stall_ended(self, lag):
+        with self.lock:
+            stall = self.current_stall or {"task": None, "stack": []}
+            self.current_stall = None
+        stall["time"] = time.time()
+        stall["duration_ms"] = round(lag * 1000, 1)
+        self.stalls.append(stall)
+        self.stall_count += 1
+        logger.warning(
+            "Event loop blocked for %.0f ms, in %s:\n%s",
+            lag * 1000,
+            stall["task"] or "a callback",
+            "\n".join(stall["stack"]) or "    (the watchdog didn't catch it)",
+        )
+
+    def stats(self):
+        lags = sorted(self.lags)
+        if not lags:
+            return {"stalls": self.stall_count}
+        return {
+            "lag_mean_ms": round(sum(lags) / len(lags) * 1000, 2),
+            "lag_p99_ms": round(lags[int(len(lags) * 0.99)] * 1000, 2),
+            "lag_max_ms": round(lags[-1] * 1000, 2),
+            "stalls": self.stall_count,
+            "recent_stalls": list(self.stalls),
+        }
@@ -1,35 +1,113 @@
 import asyncio
 import logging
+import os
 import time
 from signal import SIGINT, SIGTERM, signal
 from typing import Optional
 
 import aiohttp
+from pyytlounge import PlaybackState, State
 
-from . import api_helpers, ytlounge
+from . import api_helpers, runtime, ytlounge
+from .background_tasks import BackgroundTasks
+from .config_reload import ConfigReloader
+from .event_recorder import EventRecorder
+from .fetch_scheduler import NOW_PLAYING
+from .logging_setup import setup_logging
+from .loop_monitor import LoopMonitor
+from .metrics import Metrics
+from .state_snapshot import StateSnapshot
+
+RESUME_MAX_AGE = 120  # Seconds, a saved playing video older than this isn't resumed
+SHUTDOWN_TIMEOUT = 5  # Seconds to send the pending reports on exit, the rest is saved
 
 
 class DeviceListener:
-    def __init__(self, api_helper, config, device, debug: bool, web_session):
+    def __init__(
+        self, api_helper, config, device, debug: bool, web_session, recorder=None
+    ):
         self.task: Optional[asyncio.Task] = None
         self.api_helper = api_helper
         self.offset = device.offset
         self.name = device.name
         self.cancelled = False
-        self.logger = logging.getLogger(f"SkipAdsTV")
-        self.web_session = web_session
-        if debug:
-            self.logger.setLevel(logging.DEBUG)
-        else:
-            self.logger.setLevel(logging.INFO)
-        sh = logging.StreamHandler()
-        sh.setFormatter(
-            logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s", "%H:%M:%S")
+        # A child of the "SkipAdsTV" logger, which has the (single) handler, see logging_setup
+        self.logger = logging.getLogger("SkipAdsTV").getChild(
+            str(self.name).replace(".", "_")
         )
-        self.logger.addHandler(sh)
-        self.logger.info(f"Đang đợi thiết bị")
+        self.web_session = web_session
+        self.heartbeat = asyncio.get_event_loop().time()
+        self.last_state = None  # The last playback state, for the state snapshot
+        self.resume_state = None  # Saved by the previous run, see restore()
+        self.restored_token = False
+        self.background = BackgroundTasks(self.logger, config.max_background_tasks)
+        self.logger.info("Đang đợi thiết bị")
         self.lounge_controller = ytlounge.YtLoungeApi(
-            device.screen_id, config, api_helper, self.logger, self.web_session
+            device.screen_id,
+            config,
+            api_helper,
+            self.logger,
+            self.web_session,
+            recorder,
+            self.background,
+        )
+
+    # Shows the supervisor the loop isn't stuck
+    def beat(self):
+        self.heartbeat = asyncio.get_running_loop().time()
+
+    def last_alive(self):
+        """Loop time of the last heartbeat or lounge event"""
+        return max(self.heartbeat, self.lounge_controller.last_event or 0)
+
+    # Saved state of this device, for StateSnapshot
+    def snapshot(self):
+        auth = self.lounge_controller.auth
+        return {
+            "auth": {
+                "lounge_id_token": auth.lounge_id_token,
+                "refresh_token": auth.refresh_token,
+                "expiry": auth.expiry,
+            },
+            "playback": self.last_state or self.resume_state,
+        }
+
+    # Picks up where the previous run left off: reuses its lounge token and re-arms the skips of the video
+    # that was playing (the first state event after connecting replaces them)
+    def restore(self, saved):
+        auth = saved.get("auth") or {}
+        if auth.get("lounge_id_token"):
+            self.lounge_controller.auth.lounge_id_token = auth["lounge_id_token"]
+            self.lounge_controller.auth.refresh_token = auth.get("refresh_token")
+            self.lounge_controller.auth.expiry = auth.get("expiry")
+            self.restored_token = True
+        self.resume_state = saved.get("playback")
+
+    def __resume(self, saved):
+        video_id = saved.get("video_id")
+        if not video_id:
+            return
+        self.last_state = saved
+        # Fetched first, before the lounge even connects
+        self.background.spawn(
+            self.api_helper.prefetch_segments(video_id, NOW_PLAYING)
+        )
+        age = time.time() - saved["time"]
+        if not saved["playing"] or not 0 <= age < RESUME_MAX_AGE:
+            return
+        state = PlaybackState(
+            self.logger,
+            {
+                "videoId": video_id,
+                "currentTime": saved["position"] + age,
+                "duration": saved["duration"],
+                "state": str(State.Playing.value),
+            },
+        )
+        self.logger.debug("Resuming %s at %.1f s", video_id, state.currentTime)
+        self.task = self.background.spawn(
+            self.process_playstatus(state, asyncio.get_running_loop().time()),
+            required=True,
         )
 
     # Ensures that we have a valid auth token
@@ -38,57 +116,86 @@ class DeviceListener:
             await asyncio.sleep(60 * 60 * 24)  # Refresh every 24 hours
             try:
                 await self.lounge_controller.refresh_auth()
-            except:
-                # traceback.print_exc()
-                pass
+            except Exception as e:
+                self.logger.debug("Could not refresh auth: %r", e)
 
     async def is_available(self):
         try:
             return await self.lounge_controller.is_available()
-        except:
-            # traceback.print_exc()
+        except Exception:
             return False
 
     # Main subscription loop
     async def loop(self):
         lounge_controller = self.lounge_controller
+        if self.resume_state:
+            self.__resume(self.resume_state)
+            self.resume_state = None
         while not self.cancelled:
             while not lounge_controller.linked():
+                self.beat()
                 try:
                     self.logger.debug("Refreshing auth")
                     await lounge_controller.refresh_auth()
-                except:
+                except Exception:
                     await asyncio.sleep(10)
+            if self.restored_token and not (await self.is_available()):
+                # The saved token may have expired, get a new one instead of waiting on it
+                self.restored_token = False
+                lounge_controller.auth.lounge_id_token = None
+                continue
             while not (await self.is_available()) and not self.cancelled:
+                self.beat()
                 await asyncio.sleep(10)
+            self.beat()
             try:
                 await lounge_controller.connect()
-            except:
+            except Exception:
                 pass
-            while not lounge_controller.connected() and not self.cancelled:
+            while (
+                not lounge_controller.connected()
+                and lounge_controller.linked()  # Unlinked when the token expired
+                and not self.cancelled
+            ):
+                self.beat()
                 # Doesn't connect to the device if it's a kids profile (it's broken)
                 await asyncio.sleep(10)
                 try:
                     await lounge_controller.connect()
-                except:
+                except Exception:
                     pass
+            if not lounge_controller.connected():
+                continue
+            self.restored_token = False
+            self.beat()
             self.logger.info(
                 "Kết nối đến %s (%s)", lounge_controller.screen_name, self.name
             )
             try:
                 sub = await lounge_controller.subscribe_monitored(self)
-                await sub
-            except:
-                pass
+                # The watchdog cancels the subscription when it goes quiet, that only ends this wait
+                await asyncio.wait([sub])
+                if not sub.cancelled() and sub.exception():
+                    self.logger.debug("Subscription ended: %r", sub.exception())
+            except Exception as e:
+                self.logger.debug("Subscription failed: %r", e)
 
     # Method called on playback state change
     async def __call__(self, state):
-        try:
+        if self.task:
             self.task.cancel()
-        except:
-            pass
-        time_start = time.time()
-        self.task = asyncio.create_task(self.process_playstatus(state, time_start))
+        # Loop time instead of wall time, so recorded sessions can be replayed on a virtual clock
+        time_start = asyncio.get_running_loop().time()
+        self.last_state = {
+            "video_id": state.videoId,
+            "position": state.currentTime,
+            "duration": state.duration,
+            "playing": state.state == State.Playing,
+            "time": time.time(),
+        }
+        self.task = self.background.spawn(
+            self.process_playstatus(state, time_start), required=True
+        )
 
     # Processes the playback state change
     async def process_playstatus(self, state, time_start):
@@ -114,52 +221,294 @@ class DeviceListener:
                 start_next_segment = next_segment["start"]
                 break
         if start_next_segment:
-            time_to_next = (
-                start_next_segment - position - (time.time() - time_start) - self.offset
-            )
+            elapsed = asyncio.get_running_loop().time() - time_start
+            time_to_next = start_next_segment - position - elapsed - self.offset
             await self.skip(time_to_next, next_segment["end"], next_segment["UUID"])
 
     # Skips to the next segment (waits for the time to pass)
     async def skip(self, time_to, position, uuids):
         await asyncio.sleep(time_to)
         self.logger.info("Đang bỏ qua: đoạn quảng cáo %s", position)
-        await asyncio.create_task(self.api_helper.mark_viewed_segments(uuids))
-        await asyncio.create_task(self.lounge_controller.seek_to(position))
+        await self.lounge_controller.seek_to(position)
+        self.api_helper.mark_viewed_segments(uuids)
 
     # Stops the connection to the device
-    async def cancel(self):
+    async def cancel(self, timeout=2):
         self.cancelled = True
-        try:
-            self.task.cancel()
-        except Exception:
-            pass
+        self.background.cancel_all()
+        for task in (
+            self.lounge_controller.subscribe_task,
+            self.lounge_controller.subscribe_task_watchdog,
+        ):
+            if task:
+                task.cancel()
+        # Leave the lounge instead of letting the session time out on YouTube's side
+        if self.lounge_controller.connected():
+            try:
+                await asyncio.wait_for(self.lounge_controller.disconnect(), timeout)
+            except Exception as e:
+                self.logger.debug("Could not disconnect: %r", e)
 
 
-async def finish(devices):
-    for i in devices:
-        await i.cancel()
+# Owns the DeviceListeners and their tasks, by screen id: devices can be started and stopped while the daemon
+# runs, and each one is supervised on its own. A device whose loop ended or that shows no sign of life
+# (heartbeat or lounge event) for `stall_timeout` seconds is restarted with a new DeviceListener, waiting
+# longer after every restart (up to `max_backoff` seconds) unless it ran fine for 10 minutes in between.
+# The other devices are never touched
+class Devices:
+    def __init__(
+        self,
+        loop,
+        api_helper,
+        config,
+        debug,
+        web_session,
+        recorder=None,
+        stall_timeout=180,
+        max_backoff=300,
+        saved_state=None,
+    ):
+        self.loop = loop
+        self.api_helper = api_helper
+        self.config = config
+        self.debug = debug
+        self.web_session = web_session
+        self.recorder = recorder
+        self.stall_timeout = stall_timeout
+        self.max_backoff = max_backoff
+        # Screen id -> state saved by the previous run, used by the first launch of the device only
+        self.saved_state = dict(saved_state or {})
+        self.devices = {}
+        self.listeners = {}
+        self.tasks = {}
+        # screen id -> restarts, last reason, current backoff, earliest next restart, last (re)start
+        self.health = {}
+
+    def start(self, device):
+        self.devices[device.screen_id] = device
+        self.health[device.screen_id] = {
+            "restarts": 0,
+            "last_restart_reason": None,
+            "backoff": 0,
+            "next_restart": 0.0,
+            "started": self.loop.time(),
+        }
+        self.__launch(device)
+
+    def __launch(self, device):
+        listener = DeviceListener(
+            self.api_helper,
+            self.config,
+            device,
+            self.debug,
+            self.web_session,
+            self.recorder,
+        )
+        if saved := self.saved_state.pop(device.screen_id, None):
+            listener.restore(saved)
+        self.listeners[device.screen_id] = listener
+        self.tasks[device.screen_id] = [
+            self.loop.create_task(listener.loop()),
+            self.loop.create_task(listener.refresh_auth_loop()),
+        ]
+
+    async def __shutdown(self, screen_id):
+        # Nothing to do if a restart is already shutting it down (or the other way around)
+        listener = self.listeners.pop(screen_id, None)
+        tasks = self.tasks.pop(screen_id, [])
+        for task in tasks:
+            task.cancel()
+        if listener:
+            await listener.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def stop(self, screen_id):
+        self.devices.pop(screen_id, None)
+        self.health.pop(screen_id, None)
+        await self.__shutdown(screen_id)
 
+    async def stop_all(self):
+        await asyncio.gather(*(self.stop(i) for i in list(self.listeners)))
+
+    # Settings that can change without reconnecting
+    def update(self, device):
+        self.devices[device.screen_id] = device
+        if listener := self.listeners.get(device.screen_id):  # Unless it's restarting
+            listener.offset = device.offset
+            listener.name = device.name
+
+    def set_auto_play(self, auto_play):
+        for listener in self.listeners.values():
+            listener.lounge_controller.auto_play = auto_play
+
+    async def supervise(self, interval=15):
+        while True:
+            await asyncio.sleep(interval)
+            now = self.loop.time()
+            for screen_id in list(self.listeners):
+                if screen_id not in self.listeners:  # Removed while restarting another one
+                    continue
+                try:
+                    reason = self.__check(screen_id, now)
+                    if reason and now >= self.health[screen_id]["next_restart"]:
+                        await self.__restart(screen_id, reason, now)
+                except Exception:
+                    logging.getLogger("SkipAdsTV").exception(
+                        "Could not supervise device %s", screen_id
+                    )
 
-def main(config, debug):
+    def __check(self, screen_id, now):
+        """Why the device needs a restart, None if it's fine"""
+        loop_task = self.tasks[screen_id][0]
+        if loop_task.done():
+            error = None if loop_task.cancelled() else loop_task.exception()
+            return f"its loop ended ({error!r})"
+        silent = now - self.listeners[screen_id].last_alive()
+        if silent > self.stall_timeout:
+            return f"no sign of life for {silent:.0f} s"
+        return None
+
+    async def __restart(self, screen_id, reason, now):
+        health = self.health[screen_id]
+        if now - health["started"] > 600:  # It had been working, start over
+            health["backoff"] = 0
+        health["restarts"] += 1
+        health["last_restart_reason"] = reason
+        health["next_restart"] = now + health["backoff"]
+        health["backoff"] = min(max(health["backoff"] * 2, 15), self.max_backoff)
+        health["started"] = now
+        listener = self.listeners[screen_id]
+        listener.logger.warning(
+            "Restarting the device (restart %d): %s", health["restarts"], reason
+        )
+        await self.__shutdown(screen_id)
+        device = self.devices.get(screen_id)
+        # Removed (or removed and added again) by a config reload while it was shutting down
+        if device is not None and screen_id not in self.listeners:
+            self.__launch(device)
+
+    def snapshot(self):
+        return {
+            screen_id: listener.snapshot()
+            for screen_id, listener in self.listeners.items()
+        }
+
+    def stats(self):
+        now = self.loop.time()
+        return {
+            listener.name: {
+                "restarts": self.health[screen_id]["restarts"],
+                "last_restart_reason": self.health[screen_id]["last_restart_reason"],
+                "seconds_since_alive": round(now - listener.last_alive(), 1),
+                "background_tasks": listener.background.stats(),
+                "ads": listener.lounge_controller.ad_breaks.stats(),
+            }
+            for screen_id, listener in self.listeners.items()
+        }
+
+
+async def shutdown(tasks, reports_task, devices, api_helper, timeout=SHUTDOWN_TIMEOUT):
+    """Stops what feeds work in (the background tasks, then the devices and their lounge sessions), then
+    sends the pending viewed reports for what's left of `timeout`. Everything still running after that is
+    cancelled, so no request outlives the HTTP session. Returns how many reports are left"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await devices.stop_all()
+    left = await api_helper.viewed_reports.drain(deadline - loop.time())
+    reports_task.cancel()
+    others = [i for i in asyncio.all_tasks() if i is not asyncio.current_task()]
+    for task in others:
+        task.cancel()
+    if others:
+        await asyncio.wait(others, timeout=max(deadline - loop.time(), 0.1))
+    return left
+
+
+def main(config, debug, record_file=None, profile=False):
+    loop_implementation = runtime.install_event_loop_policy(config.event_loop)
     loop = asyncio.get_event_loop_policy().get_event_loop()
     tasks = []  # Save the tasks so the interpreter doesn't garbage collect them
-    devices = []  # Save the devices to close them later
+    log_listener = setup_logging(debug, config.log_format)
     if debug:
         loop.set_debug(True)
     asyncio.set_event_loop(loop)
-    tcp_connector = aiohttp.TCPConnector(ttl_dns_cache=300)
+    ytlounge.set_api_base(config.lounge_api)
+    if profile:
+        from .profiling import Profiler
+
+        Profiler(config.data_dir).install(loop)
+    logging.getLogger("SkipAdsTV").debug("Using the %s event loop", loop_implementation)
+    tcp_connector = runtime.new_connector(config)
     web_session = aiohttp.ClientSession(loop=loop, connector=tcp_connector)
     api_helper = api_helpers.ApiHelper(config, web_session)
+    recorder = EventRecorder(record_file) if record_file else None
+    reports_task = loop.create_task(api_helper.viewed_reports.run())
+    # Loop lag and whatever blocks the loop for longer than the threshold, without loop.set_debug
+    loop_monitor = None
+    if config.slow_callback_threshold:
+        loop_monitor = LoopMonitor(threshold=config.slow_callback_threshold)
+        loop_monitor.start(loop)
+    metrics = None
+    if config.data_dir:
+        metrics = Metrics(os.path.join(config.data_dir, "metrics.json"))
+        metrics.register("api", api_helper.stats)
+        if loop_monitor:
+            metrics.register("loop", loop_monitor.stats)
+        tasks.append(loop.create_task(metrics.run()))
+    state_snapshot = saved_state = None
+    if config.data_dir:
+        state_snapshot = StateSnapshot(os.path.join(config.data_dir, "state.json"))
+        saved_state = state_snapshot.load()
+    devices = Devices(
+        loop,
+        api_helper,
+        config,
+        debug,
+        web_session,
+        recorder,
+        saved_state=saved_state,
+    )
     for i in config.devices:
-        device = DeviceListener(api_helper, config, i, debug, web_session)
-        devices.append(device)
-        tasks.append(loop.create_task(device.loop()))
-        tasks.append(loop.create_task(device.refresh_auth_loop()))
-    signal(SIGINT, lambda s, f: loop.stop())
-    signal(SIGTERM, lambda s, f: loop.stop())
+        devices.start(i)
+    tasks.append(loop.create_task(devices.supervise()))
+    if state_snapshot:
+        tasks.append(loop.create_task(state_snapshot.run(devices.snapshot)))
+    if metrics:
+        metrics.register("devices", devices.stats)
+    # Changes to config.json are applied without a restart
+    tasks.append(
+        loop.create_task(ConfigReloader(config, api_helper, devices).run())
+    )
+    for signum in (SIGINT, SIGTERM):
+        try:
+            loop.add_signal_handler(signum, loop.stop)
+        except NotImplementedError:  # Windows
+            signal(signum, lambda s, f: loop.call_soon_threadsafe(loop.stop))
     loop.run_forever()
     print("Cancelling tasks and exiting...")
-    loop.run_until_complete(finish(devices))
+    started = time.monotonic()
+    if loop_monitor:
+        loop_monitor.stop()
+    if state_snapshot:  # Before the devices are gone
+        state_snapshot.save(devices.snapshot())
+    reports_left = loop.run_until_complete(
+        shutdown(tasks, reports_task, devices, api_helper)
+    )
+    api_helper.save()  # The reports left included
+    if metrics:
+        metrics.save()
     loop.run_until_complete(web_session.close())
     loop.run_until_complete(tcp_connector.close())
+    if recorder:
+        recorder.close()
+    loop.run_until_complete(loop.shutdown_asyncgens())
     loop.close()
+    logging.getLogger("SkipAdsTV").info(
+        "Shut down in %.2f s, %d viewed reports saved for the next run",
+        time.monotonic() - started,
+        reports_left,
+    )
+    log_listener.stop()
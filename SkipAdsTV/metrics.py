@@ -0,0 +1,30 @@
+import asyncio
+import time
+
+from .helpers import save_json
+
+
+# Collects the stats of the daemon's components and writes them to data_dir/metrics.json every
+# `interval` seconds, so they can be looked at (or scraped) while it runs
+class Metrics:
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = interval
+        self.sources = {}  # name -> function returning a JSON-serializable dict
+
+    def register(self, name, func):
+        self.sources[name] = func
+
+    def snapshot(self):
+        snapshot = {"time": time.time()}
+        for name, func in self.sources.items():
+            snapshot[name] = func()
+        return snapshot
+
+    def save(self):
+        save_json(self.path, self.snapshot(), indent=4)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.save()
@@ -0,0 +1,62 @@
+import asyncio
+import json
+from collections import OrderedDict
+
+from cache.lru import LRU
+
+from .helpers import save_json
+
+
+# LRU that is kept in a JSON file, for values that never go stale (e.g. the channel of a video).
+# Changes are written at most every `save_delay` seconds (and on save()), atomically, least recently used
+# entries first so the order survives a restart. With path=None it's a plain in-memory LRU
+class PersistentLRU(LRU):
+    def __init__(self, path, maxsize, save_delay=30):
+        super().__init__(maxsize=maxsize)
+        self.path = path
+        self.save_delay = save_delay
+        self.save_handle = None
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Could not load {self.path}, starting empty: {e}")
+            return
+        for key, value in list(data.items())[-self.maxsize :]:
+            OrderedDict.__setitem__(self, key, value)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.dirty = True
+        self.schedule_save()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.dirty = True
+        self.schedule_save()
+
+    def schedule_save(self):
+        if not self.path or self.save_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:  # Not in the event loop, save() has to be called
+            return
+        self.save_handle = loop.call_later(self.save_delay, self.save)
+
+    def save(self):
+        if self.save_handle is not None:
+            self.save_handle.cancel()
+            self.save_handle = None
+        if not self.path or not self.dirty:
+            return
+        if save_json(self.path, dict(self), separators=(",", ":")):
+            self.dirty = False
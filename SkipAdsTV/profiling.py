@@ -0,0 +1,98 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import signal
+import time
+import tracemalloc
+from collections import Counter
+
+logger = logging.getLogger("SkipAdsTV")
+
+
+def _task_name(task):
+    coro = task.get_coro()
+    return getattr(coro, "__qualname__", None) or repr(coro)
+
+
+# Only installed with --profile, so there is no cost at all when it's not used.
+# SIGUSR1: starts a cProfile session, or stops it and writes its stats to data_dir
+# SIGUSR2: writes the running asyncio tasks and the top tracemalloc allocations to data_dir
+class Profiler:
+    def __init__(self, data_dir, top=30, max_tasks=50, traceback_frames=5):
+        self.data_dir = data_dir
+        self.top = top
+        self.max_tasks = max_tasks
+        self.traceback_frames = traceback_frames
+        self.profile = None
+
+    def install(self, loop):
+        tracemalloc.start(self.traceback_frames)
+        if not hasattr(signal, "SIGUSR1"):  # Windows
+            logger.warning("Profiling signals are not available on this platform")
+            return
+        loop.add_signal_handler(signal.SIGUSR1, self.toggle_profile)
+        loop.add_signal_handler(signal.SIGUSR2, self.dump)
+        logger.info(
+            "Profiling enabled (pid %s): SIGUSR1 toggles cProfile, SIGUSR2 dumps tasks"
+            " and memory",
+            os.getpid(),
+        )
+
+    def _path(self, kind, extension):
+        return os.path.join(
+            self.data_dir, f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}.{extension}"
+        )
+
+    def toggle_profile(self):
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            logger.info("cProfile started")
+            return
+        self.profile.disable()
+        path = self._path("profile", "pstats")
+        self.profile.dump_stats(path)
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+        with open(path[: -len("pstats")] + "txt", "w", encoding="utf-8") as f:
+            f.write(stream.getvalue())
+        self.profile = None
+        logger.info("cProfile stopped, stats written to %s", path)
+
+    def dump(self):
+        self.dump_tasks()
+        self.dump_memory()
+
+    def dump_tasks(self):
+        tasks = list(asyncio.all_tasks())
+        path = self._path("tasks", "txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"{len(tasks)} tasks\n\n")
+            for name, count in Counter(map(_task_name, tasks)).most_common():
+                f.write(f"{count:>6}  {name}\n")
+            # Only a sample of the stacks, a big fleet can have thousands of tasks
+            f.write(f"\nStacks of {min(len(tasks), self.max_tasks)} tasks:\n")
+            for task in tasks[: self.max_tasks]:
+                f.write(f"\n{task.get_name()} {_task_name(task)}\n")
+                for frame in task.get_stack(limit=self.traceback_frames):
+                    code = frame.f_code
+                    f.write(
+                        f"    {code.co_filename}:{frame.f_lineno} in {code.co_name}\n"
+                    )
+        logger.info("Tasks written to %s", path)
+
+    def dump_memory(self):
+        snapshot = tracemalloc.take_snapshot()
+        path = self._path("tracemalloc", "txt")
+        with open(path, "w", encoding="utf-8") as f:
+            current, peak = tracemalloc.get_traced_memory()
+            f.write(f"Traced: {current / 1024:.1f} KiB (peak {peak / 1024:.1f} KiB)\n\n")
+            for stat in snapshot.statistics("traceback")[: self.top]:
+                f.write(f"{stat}\n")
+                for line in stat.traceback.format():
+                    f.write(f"    {line}\n")
+        logger.info("Memory snapshot written to %s", path)
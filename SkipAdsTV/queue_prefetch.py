@@ -0,0 +1,88 @@
+import time
+
+
+# At most `per_minute` requests a minute, in bursts of up to as many (a token bucket). 0 allows none
+class RequestBudget:
+    def __init__(self, per_minute, clock=time.monotonic):
+        self.per_minute = per_minute
+        self.clock = clock  # Current time in seconds
+        self.tokens = float(per_minute)
+        self.updated = clock()
+        self.spent = 0
+        self.denied = 0
+
+    def take(self):
+        """Spends one request, False when the budget is used up"""
+        now = self.clock()
+        self.tokens = min(
+            self.per_minute,
+            self.tokens + (now - self.updated) * self.per_minute / 60,
+        )
+        self.updated = now
+        if self.tokens < 1:
+            self.denied += 1
+            return False
+        self.tokens -= 1
+        self.spent += 1
+        return True
+
+    def stats(self):
+        return {
+            "per_minute": self.per_minute,
+            "spent": self.spent,
+            "denied": self.denied,
+        }
+
+
+def _index(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Follows the playlist or queue a device is playing (listId and currentIndex of nowPlaying and
+# playlistModified events) and warms the segments of its next `count` videos. The videos of the list come
+# from the events when they carry them (videoIds), otherwise from the YouTube Data API
+class QueueTracker:
+    def __init__(self, api_helper, count=3):
+        self.api_helper = api_helper
+        self.count = count
+        self.list_id = None
+        self.video_ids = []
+        self.warmed = None  # (list id, index) last warmed, events repeat them a lot
+
+    def update(self, data):
+        """Takes the data of a nowPlaying or playlistModified event. Returns the coroutine that warms the
+        next videos, None when there's nothing new to warm"""
+        list_id = data.get("listId") or None
+        if list_id != self.list_id:
+            self.list_id = list_id
+            self.video_ids = []
+            self.warmed = None
+        video_ids = data.get("videoIds")
+        if video_ids:
+            if isinstance(video_ids, str):
+                video_ids = video_ids.split(",")
+            self.video_ids = [i for i in video_ids if i]
+        index = _index(data.get("currentIndex"))
+        video_id = data.get("videoId")
+        if video_id and video_id in self.video_ids:
+            if index is None or self.video_ids[index : index + 1] != [video_id]:
+                index = self.video_ids.index(video_id)  # Shuffled, or the list changed
+        if list_id is None or index is None or self.count <= 0:
+            return None
+        if (list_id, index) == self.warmed:
+            return None
+        self.warmed = (list_id, index)
+        return self.__warm(list_id, index)
+
+    async def __warm(self, list_id, index):
+        video_ids = self.video_ids
+        if not video_ids:
+            video_ids = await self.api_helper.get_playlist_items(
+                list_id, index + 1 + self.count
+            )
+        await self.api_helper.prefetch_queue(
+            video_ids[index + 1 : index + 1 + self.count]
+        )
@@ -0,0 +1,41 @@
+import asyncio
+
+import aiohttp
+
+
+def install_event_loop_policy(kind="auto"):
+    """Makes the event loop policy create `kind` loops: "uvloop", "asyncio" or "auto" (uvloop when it's
+    installed). uvloop is optional, it falls back to asyncio's loop. Returns the one that will be used"""
+    if kind in ("auto", "uvloop"):
+        try:
+            import uvloop
+        except ImportError:
+            if kind == "uvloop":
+                print("uvloop is not installed, using asyncio's event loop")
+        else:
+            # A loop may already be set on it (tools/simulator.py), don't throw it away
+            if not isinstance(asyncio.get_event_loop_policy(), uvloop.EventLoopPolicy):
+                asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return "uvloop"
+    if type(asyncio.get_event_loop_policy()) is not asyncio.DefaultEventLoopPolicy:
+        asyncio.set_event_loop_policy(asyncio.DefaultEventLoopPolicy())
+    return "asyncio"
+
+
+def new_connector(config):
+    """The connector shared by every HTTP request. Every device keeps a lounge long-poll open, so the
+    connection limit grows with the devices (aiohttp's default of 100 starves bigger fleets)"""
+    resolver = None
+    try:
+        import aiodns  # noqa: F401 Optional, resolves on the loop instead of getaddrinfo threads
+
+        resolver = aiohttp.AsyncResolver()
+    except ImportError:
+        pass
+    return aiohttp.TCPConnector(
+        limit=config.http_connection_limit or 2 * len(config.devices) + 50,
+        limit_per_host=config.http_limit_per_host,
+        keepalive_timeout=config.http_keepalive_timeout,
+        ttl_dns_cache=config.dns_cache_ttl,
+        resolver=resolver,
+    )
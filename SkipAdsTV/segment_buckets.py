@@ -0,0 +1,206 @@
+import json
+import re
+import time
+from collections import Counter, OrderedDict
+from hashlib import blake2b
+
+_decoder = json.JSONDecoder()
+_VIDEO_ID = re.compile(rb'"videoID"\s*:\s*"([^"\\]*)"')
+
+
+# The skipSegments response for a hash prefix: the entries of every video whose hash starts with it.
+# Only the entries that are asked for get decoded. A video is found by searching the raw text for its
+# "videoID", then only the object around it is decoded, so the rest of the response never becomes
+# Python objects (not even a str)
+class SegmentBucket:
+    def __init__(self, body: bytes, etag=None, last_modified=None):
+        self.body = body
+        # Validators for revalidating the bucket once it expires
+        self.etag = etag
+        self.last_modified = last_modified
+        self.entries = {}  # video id -> (decoded entry, digest of its raw bytes), (None, None) if missing
+
+    def get(self, vid_id):
+        """The entry ({"videoID", "segments", ...}) of a video, None if it has no segments"""
+        return self.__get(vid_id)[0]
+
+    def digest(self, vid_id):
+        """Hash of the video's raw entry, the same while its segments don't change"""
+        return self.__get(vid_id)[1]
+
+    def validators(self):
+        """Headers for a conditional request of this bucket"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def __get(self, vid_id):
+        try:
+            return self.entries[vid_id]
+        except KeyError:
+            entry = self.entries[vid_id] = self.__find(vid_id)
+            return entry
+
+    def __find(self, vid_id):
+        vid_id_bytes = vid_id.encode("utf-8")
+        # The API's responses are compact, bytes.find is several times faster than the regex
+        position = self.body.find(b'"videoID":"' + vid_id_bytes + b'"')
+        if position != -1:
+            match = _VIDEO_ID.match(self.body, position)
+        else:
+            needle = rb'"videoID"\s*:\s*"' + re.escape(vid_id_bytes) + rb'"'
+            match = re.search(needle, self.body)
+        if match is None:
+            return None, None
+        # The entry ends before the "videoID" of the next one, so that's all that needs decoding
+        next_match = _VIDEO_ID.search(self.body, match.end())
+        end = next_match.start() if next_match else len(self.body)
+        # The entry is the closest object before the match that contains it. When "videoID" isn't its
+        # first key, the closer ones are its segments, which are small and end before the match
+        start = self.body.rfind(b"{", 0, match.start())
+        while start != -1:
+            text = self.body[start:end].decode("utf-8")
+            try:
+                entry, length = _decoder.raw_decode(text)
+            except ValueError:
+                entry, length = None, 0
+            if isinstance(entry, dict) and length > len(
+                self.body[start : match.start()].decode("utf-8")
+            ):
+                if entry.get("videoID") != vid_id:
+                    return None, None
+                raw = text[:length].encode("utf-8")
+                return entry, blake2b(raw, digest_size=16).digest()
+            start = self.body.rfind(b"{", 0, start)
+        return None, None
+
+
+# Recent SegmentBuckets by hash prefix. Expired buckets are kept (until they are the least recently used)
+# so they can be revalidated with a conditional request. The prefix length can change while the daemon
+# runs, so a video is looked up under every length: a bucket for a shorter prefix of its hash contains it
+# too
+class BucketCache:
+    def __init__(self, time_to_live=300, maxsize=32, clock=time.monotonic):
+        self.time_to_live = time_to_live
+        self.clock = clock  # Current time in seconds
+        self.maxsize = maxsize
+        self.buckets = OrderedDict()  # prefix -> (bucket, expiry)
+        self.lengths = Counter()  # prefix length -> buckets with it
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, vid_hash):
+        prefix = self.__find(vid_hash)
+        if prefix is None:
+            self.misses += 1
+            return None
+        self.buckets.move_to_end(prefix)
+        self.hits += 1
+        return self.buckets[prefix][0]
+
+    def __contains__(self, vid_hash):
+        """Whether a fresh bucket has the video, without counting it as a hit or miss nor making it the
+        most recently used"""
+        return self.__find(vid_hash) is not None
+
+    def __find(self, vid_hash):
+        """Prefix of a fresh bucket that has the video, None if there's none"""
+        now = self.clock()
+        for length in sorted(self.lengths):
+            prefix = vid_hash[:length]
+            item = self.buckets.get(prefix)
+            if item is not None and item[1] >= now:  # Expired ones stay, to be revalidated
+                return prefix
+        return None
+
+    def get_stale(self, prefix):
+        """The bucket for exactly this prefix, even if it expired"""
+        item = self.buckets.get(prefix)
+        return item[0] if item else None
+
+    def put(self, prefix, bucket):
+        if prefix in self.buckets:
+            self.__remove(prefix)
+        self.buckets[prefix] = (bucket, self.clock() + self.time_to_live)
+        self.lengths[len(prefix)] += 1
+        while len(self.buckets) > self.maxsize:
+            self.__remove(next(iter(self.buckets)))
+
+    def clear(self):
+        self.buckets.clear()
+        self.lengths.clear()
+
+    def __remove(self, prefix):
+        del self.buckets[prefix]
+        self.lengths[len(prefix)] -= 1
+        if not self.lengths[len(prefix)]:
+            del self.lengths[len(prefix)]
+
+
+# Length of the hash prefix sent to SponsorBlock. Shorter prefixes are more private (more unrelated videos
+# come back with the one we want) and make bigger buckets that are reused more, longer ones make lighter
+# responses. In adaptive mode it follows the average response size and latency: one character shorter
+# when responses are tiny, one longer when they are heavy, never longer than max_length (the privacy
+# limit) nor outside what the API accepts. Each character is a 16x change in size, so the thresholds
+# are far enough apart to not flip back and forth
+class PrefixLength:
+    API_MIN_LENGTH = 4  # SponsorBlock rejects shorter prefixes
+    API_MAX_LENGTH = 32  # And longer ones
+
+    def __init__(
+        self,
+        length=4,
+        adaptive=False,
+        max_length=5,
+        tiny_bytes=2048,
+        heavy_bytes=65536,
+        heavy_latency=1.0,
+        min_samples=20,
+    ):
+        self.length = length
+        self.adaptive = adaptive
+        self.max_length = min(max(max_length, length), self.API_MAX_LENGTH)
+        self.tiny_bytes = tiny_bytes
+        self.heavy_bytes = heavy_bytes
+        self.heavy_latency = heavy_latency
+        self.min_samples = min_samples
+        self.__reset()
+
+    def __reset(self):
+        self.samples = 0
+        self.average_bytes = 0.0
+        self.average_latency = 0.0
+
+    def record(self, size, latency):
+        if not self.adaptive:
+            return
+        self.samples += 1
+        weight = max(1 / self.samples, 0.1)  # Plain mean at first, then moving average
+        self.average_bytes += (size - self.average_bytes) * weight
+        self.average_latency += (latency - self.average_latency) * weight
+        if self.samples < self.min_samples:
+            return
+        heavy = (
+            self.average_bytes > self.heavy_bytes
+            or self.average_latency > self.heavy_latency
+        )
+        if heavy and self.length < self.max_length:
+            self.length += 1
+            self.__reset()
+        elif (
+            not heavy
+            and self.average_bytes < self.tiny_bytes
+            and self.length > self.API_MIN_LENGTH
+        ):
+            self.length -= 1
+            self.__reset()
+
+    def stats(self):
+        return {
+            "length": self.length,
+            "average_bytes": round(self.average_bytes),
+            "average_latency_ms": round(self.average_latency * 1000, 1),
+        }
@@ -0,0 +1,191 @@
+import asyncio
+from collections import deque
+
+import aiohttp
+from aiohttp import ClientSession
+
+
+class SponsorBlockUnavailable(Exception):
+    """None of the SponsorBlock servers could answer (all failing, or their circuit breakers are open)"""
+
+
+class SponsorBlockResponse:
+    def __init__(self, status, body: bytes, headers, base_url):
+        self.status = status
+        self.body = body
+        self.headers = headers
+        self.base_url = base_url
+
+    def text(self):
+        return self.body.decode("utf-8", errors="replace")
+
+
+# A SponsorBlock server (the official one or a compatible mirror), with its circuit breaker and health.
+# After `failure_threshold` failures in a row the breaker opens and the server isn't used for
+# `reset_timeout` seconds; then a single trial request decides whether it closes again
+class Mirror:
+    def __init__(self, base_url, failure_threshold, reset_timeout):
+        self.base_url = base_url
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latency = 0.5  # Moving average, seconds
+        self.latencies = deque(maxlen=100)
+        self.failures = 0  # In a row
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self.trial_in_flight else "open"
+
+    def available(self, now):
+        if self.opened_at is None:
+            return True
+        return not self.trial_in_flight and now - self.opened_at >= self.reset_timeout
+
+    def score(self):
+        """Lower is healthier"""
+        return self.latency * (1 + self.failures)
+
+    def latency_percentile(self, fraction):
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+
+    def record_success(self, latency):
+        self.latency = 0.8 * self.latency + 0.2 * latency
+        self.latencies.append(latency)
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self, now):
+        self.errors += 1
+        self.failures += 1
+        if self.trial_in_flight or self.failures >= self.failure_threshold:
+            self.opened_at = now
+        self.trial_in_flight = False
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "latency_ms": round(self.latency * 1000, 1),
+            "failures_in_a_row": self.failures,
+            "requests": self.requests,
+            "errors": self.errors,
+        }
+
+
+# Client for the SponsorBlock API used by ApiHelper: every request has a timeout, goes to the healthiest
+# server whose breaker is closed and fails over to the next one. With hedging, if the first server hasn't
+# answered within its usual latency (`hedge_percentile` of its recent requests) the next one is tried too,
+# and the first answer wins. When no server is usable it fails fast with SponsorBlockUnavailable
+class SponsorBlockClient:
+    def __init__(
+        self,
+        web_session: ClientSession,
+        base_urls,
+        timeout=5.0,
+        failure_threshold=3,
+        reset_timeout=30.0,
+        hedge=False,
+        hedge_percentile=0.9,
+        hedge_min_samples=20,
+    ) -> None:
+        self.web_session = web_session
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        # Paths are appended to the base URLs, with or without a trailing slash in the config
+        self.mirrors = [
+            Mirror(i.rstrip("/") + "/", failure_threshold, reset_timeout)
+            for i in base_urls
+        ]
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedged_requests = 0
+
+    def ranked_mirrors(self):
+        now = asyncio.get_running_loop().time()
+        return sorted(
+            (i for i in self.mirrors if i.available(now)), key=lambda i: i.score()
+        )
+
+    def hedge_delay(self, mirror):
+        if len(mirror.latencies) < self.hedge_min_samples:
+            return None
+        return mirror.latency_percentile(self.hedge_percentile)
+
+    async def request(self, method, path, hedge=None, **kwargs):
+        """Returns a SponsorBlockResponse from the first server that answers without failing (5xx and 429
+        count as failures). Only set hedge for idempotent requests"""
+        hedge = self.hedge if hedge is None else hedge
+        candidates = iter(self.ranked_mirrors())
+        pending = set()
+        current = None
+
+        def start_next():
+            nonlocal current
+            mirror = next(candidates, None)
+            if mirror is None:
+                return False
+            current = mirror
+            if mirror.opened_at is not None:
+                mirror.trial_in_flight = True
+            pending.add(asyncio.create_task(self.__request(mirror, method, path, kwargs)))
+            return True
+
+        if not start_next():
+            raise SponsorBlockUnavailable("All SponsorBlock servers are failing")
+        try:
+            while pending:
+                timeout = self.hedge_delay(current) if hedge else None
+                done, pending = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:  # Too slow, try the next server alongside
+                    if start_next():
+                        self.hedged_requests += 1
+                    else:
+                        hedge = False
+                    continue
+                for task in done:
+                    if (response := task.result()) is not None:
+                        return response
+                if not pending:  # Failed, fail over
+                    start_next()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise SponsorBlockUnavailable("All SponsorBlock servers failed")
+
+    async def __request(self, mirror, method, path, kwargs):
+        loop = asyncio.get_running_loop()
+        mirror.requests += 1
+        start = loop.time()
+        try:
+            async with self.web_session.request(
+                method, mirror.base_url + path, timeout=self.timeout, **kwargs
+            ) as response:
+                body = await response.read()
+        except asyncio.CancelledError:
+            mirror.trial_in_flight = False
+            raise
+        except Exception:
+            mirror.record_failure(loop.time())
+            return None
+        if response.status >= 500 or response.status == 429:
+            mirror.record_failure(loop.time())
+            return None
+        mirror.record_success(loop.time() - start)
+        return SponsorBlockResponse(
+            response.status, body, response.headers, mirror.base_url
+        )
+
+    def stats(self):
+        return {
+            "hedged_requests": self.hedged_requests,
+            "servers": {i.base_url: i.stats() for i in self.mirrors},
+        }
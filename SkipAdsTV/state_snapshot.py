@@ -0,0 +1,40 @@
+import asyncio
+import json
+import time
+
+from .helpers import save_json
+
+SNAPSHOT_VERSION = 1
+
+
+# The daemon's runtime state, kept in data_dir/state.json so a restart picks up where the last run left
+# off: per device (by screen id) its lounge auth (no token refresh before reconnecting) and the video it
+# was playing, with the position and when it was seen. Written every `interval` seconds and on exit,
+# atomically. A missing, broken or older snapshot is ignored
+class StateSnapshot:
+    def __init__(self, path, interval=30):
+        self.path = path
+        self.interval = interval
+
+    def load(self):
+        """Screen id -> the device's saved state, empty if there's nothing usable"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print(f"Could not load {self.path}, starting fresh: {e}")
+            return {}
+        if not isinstance(data, dict) or data.get("version") != SNAPSHOT_VERSION:
+            return {}
+        return data.get("devices", {})
+
+    def save(self, devices):
+        data = {"version": SNAPSHOT_VERSION, "time": time.time(), "devices": devices}
+        save_json(self.path, data, separators=(",", ":"))
+
+    async def run(self, get_devices):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.save(get_devices())
@@ -0,0 +1,118 @@
+import time
+from collections import Counter
+
+from cache.lru import LRU
+
+
+# How long get_segments keeps the segments of a video before asking SponsorBlock again. ttl() returns
+# what AsyncConditionalTTL takes: True (forever), False (its default, 5 minutes) or a number of seconds.
+# `locked` is what process_segments says (every segment is locked, or there are none), `fetched` whether
+# this call fetched or revalidated the entry from SponsorBlock (rather than finding it in a cached bucket,
+# or sharing the request of another call)
+class FixedTTL:
+    """Forever when every segment is locked, 5 minutes otherwise"""
+
+    min_ttl = 300
+
+    def ttl(self, vid_id, entry, digest, locked, fetched=True):
+        return locked
+
+    def stats(self):
+        return {}
+
+
+# Derives the TTL from the video's entry and from how often refreshing it actually changed something:
+# - every segment locked: forever
+# - the lowest vote count of the unlocked segments: well voted segments rarely change, new ones do
+# - segments submitted in the last `new_age` seconds (when the server sends timeSubmitted): min_ttl
+# - each refresh that found the entry unchanged doubles the TTL, one that changed it starts over. Only
+#   the ones that reached SponsorBlock count, an entry from a cached bucket keeps its last TTL
+# Videos without segments get the same doubling, new uploads get their segments in the first hours
+class AdaptiveTTL:
+    def __init__(
+        self,
+        base=300,
+        min_ttl=60,
+        max_ttl=6 * 60 * 60,
+        new_age=24 * 60 * 60,
+        history_size=1000,
+        max_entries_reported=20,
+    ):
+        self.base = base
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.new_age = new_age
+        self.max_entries_reported = max_entries_reported
+        # Video id -> [digest, refreshes, changes, unchanged refreshes in a row, last ttl]
+        self.history = LRU(maxsize=history_size)
+        self.assigned = Counter()  # TTL range -> times assigned
+        self.refreshes = 0
+        self.changes = 0
+
+    def ttl(self, vid_id, entry, digest, locked, fetched=True):
+        history = self.history.get(vid_id)
+        if not fetched and history is not None and history[0] == digest:
+            self.history.move_to_end(vid_id)
+            return history[4]
+        if history is None:
+            history = self.history[vid_id] = [digest, 0, 0, 0, None]
+        else:
+            self.history.move_to_end(vid_id)
+            history[1] += 1
+            self.refreshes += 1
+            if history[0] != digest:
+                history[0] = digest
+                history[2] += 1
+                history[3] = 0
+                self.changes += 1
+            else:
+                history[3] += 1
+        segments = entry.get("segments") if entry else None
+        if segments and locked:
+            ttl = True
+        else:
+            ttl = self.__ttl(segments, history[3])
+        history[4] = ttl
+        self.assigned[self.__range(ttl)] += 1
+        return ttl
+
+    def __ttl(self, segments, unchanged):
+        ttl = self.base
+        if segments:
+            unlocked = [i for i in segments if i.get("locked") != 1]
+            votes = min((i.get("votes", 0) for i in unlocked), default=0)
+            if votes >= 10:
+                ttl *= 4
+            elif votes >= 3:
+                ttl *= 2
+            elif votes <= 0:
+                ttl /= 2
+            submitted = [i["timeSubmitted"] for i in unlocked if "timeSubmitted" in i]
+            if submitted and time.time() - max(submitted) / 1000 < self.new_age:
+                ttl = self.min_ttl
+        ttl *= 2 ** min(unchanged, 6)
+        return int(min(max(ttl, self.min_ttl), self.max_ttl))
+
+    @staticmethod
+    def __range(ttl):
+        if ttl is True:
+            return "forever"
+        for limit, name in ((60, "<=1m"), (300, "<=5m"), (1800, "<=30m"), (7200, "<=2h")):
+            if ttl <= limit:
+                return name
+        return ">2h"
+
+    def stats(self):
+        recent = list(self.history.items())[-self.max_entries_reported :]
+        return {
+            "refreshes": self.refreshes,
+            "changed": self.changes,
+            "assigned": dict(self.assigned),
+            "entries": {
+                vid_id: {"ttl": i[4], "refreshes": i[1], "changes": i[2]}
+                for vid_id, i in reversed(recent)
+            },
+        }
+
+
+TTL_POLICIES = {"fixed": FixedTTL, "adaptive": AdaptiveTTL}
@@ -0,0 +1,118 @@
+import asyncio
+import time
+
+from .persistent_cache import PersistentLRU
+from .sponsorblock_client import SponsorBlockUnavailable
+
+
+# Sends the viewedVideoSponsorTime reports in the background, so the skip itself never waits on them.
+# At most `concurrency` requests are in flight and they are spaced `interval` seconds apart; failed
+# reports are retried with exponential backoff. The reports waiting to be sent are kept in data_dir so
+# they survive restarts, and a segment skipped on several devices is only reported once
+class ViewedReportQueue:
+    def __init__(
+        self,
+        sponsorblock,
+        path,
+        concurrency=2,
+        interval=0.2,
+        max_attempts=8,
+        max_backoff=600,
+        dedupe_window=600,
+        clock=time.monotonic,
+    ) -> None:
+        self.sponsorblock = sponsorblock
+        self.clock = clock  # Current time in seconds, for dedupe_window
+        self.concurrency = concurrency
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.dedupe_window = dedupe_window
+        # UUID -> failed attempts, for every report not sent yet
+        self.pending = PersistentLRU(path, maxsize=10000, save_delay=5)
+        self.recently_sent = {}  # UUID -> time it was sent
+        self.queue = asyncio.Queue()
+        self.next_send = 0.0
+        self.sending = 0  # Reports out of the queue, being sent or waiting for the rate limit
+        self.sent = 0
+        self.dropped = 0
+
+    def put(self, uuids):
+        now = self.clock()
+        for uuid in uuids:
+            if uuid in self.pending:
+                continue
+            sent_at = self.recently_sent.get(uuid)
+            if sent_at is not None and now - sent_at < self.dedupe_window:
+                continue
+            self.pending[uuid] = 0
+            self.queue.put_nowait(uuid)
+
+    async def run(self):
+        for uuid in list(self.pending.keys()):  # Left over from the last run
+            self.queue.put_nowait(uuid)
+        await asyncio.gather(*(self.__worker() for _ in range(self.concurrency)))
+
+    async def __worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            uuid = await self.queue.get()
+            if uuid not in self.pending:  # Dropped to keep the queue bounded
+                continue
+            # In flight (for drain) from the moment it leaves the queue, waiting for the rate limit too
+            self.sending += 1
+            try:
+                # Rate limit, shared by all workers
+                now = loop.time()
+                self.next_send = max(self.next_send, now) + self.interval
+                await asyncio.sleep(self.next_send - self.interval - now)
+                sent = await self.__send(uuid)
+            finally:
+                self.sending -= 1
+            if sent:
+                del self.pending[uuid]
+                self.sent += 1
+                self.__remember_sent(uuid)
+                continue
+            attempts = self.pending[uuid] + 1
+            if attempts >= self.max_attempts:
+                del self.pending[uuid]
+                self.dropped += 1
+                continue
+            self.pending[uuid] = attempts
+            loop.call_later(
+                min(2**attempts, self.max_backoff), self.queue.put_nowait, uuid
+            )
+
+    async def __send(self, uuid):
+        """Returns False if the report should be retried"""
+        try:
+            await self.sponsorblock.request(
+                "POST", "viewedVideoSponsorTime/", hedge=False, params={"UUID": uuid}
+            )
+        except SponsorBlockUnavailable:
+            return False
+        # Other errors (4xx) won't get better by retrying
+        return True
+
+    def __remember_sent(self, uuid):
+        now = self.clock()
+        self.recently_sent[uuid] = now
+        if len(self.recently_sent) > 1000:
+            self.recently_sent = {
+                k: v
+                for k, v in self.recently_sent.items()
+                if now - v < self.dedupe_window
+            }
+
+    async def drain(self, timeout):
+        """Waits up to `timeout` seconds for the queued reports to be sent (not for the ones waiting to be
+        retried), returns how many are left. Those stay pending, save() keeps them for the next run"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while (not self.queue.empty() or self.sending) and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        return len(self.pending)
+
+    def save(self):
+        self.pending.save()
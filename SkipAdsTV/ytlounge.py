@@ -2,11 +2,18 @@ import asyncio
 import json
 
 import pyytlounge
+import pyytlounge.wrapper
 from aiohttp import ClientSession
 
+from .ad_skip import AdBreakTracker
+from .background_tasks import BackgroundTasks
 from .constants import youtube_client_blacklist
+from .queue_prefetch import QueueTracker
 
-create_task = asyncio.create_task
+
+# pyytlounge builds its URLs from a module level base, so it can only be changed for every screen at once
+def set_api_base(url):
+    pyytlounge.wrapper.api_base = url.rstrip("/")
 
 
 class YtLoungeApi(pyytlounge.YtLoungeApi):
@@ -17,9 +24,13 @@ class YtLoungeApi(pyytlounge.YtLoungeApi):
         api_helper=None,
         logger=None,
         web_session: ClientSession = None,
+        recorder=None,
+        background=None,
     ):
         super().__init__("SkipAdsTV", logger=logger)
         if web_session is not None:
+            # Drop the session pyytlounge opened (without leaving it unclosed)
+            self.session.detach()
             self.session = web_session  # And use the one we passed
         self.auth.screen_id = screen_id
         self.auth.lounge_id_token = None
@@ -29,20 +40,30 @@ class YtLoungeApi(pyytlounge.YtLoungeApi):
         self.subscribe_task_watchdog = None
         self.callback = None
         self.logger = logger
+        self.recorder = recorder
+        # Tasks started from _process_event, which can't await anything
+        self.background = background or BackgroundTasks(logger)
+        self.last_event = None  # Loop time of the last lounge event (watchdog, supervisor)
+        self.lounge_status = None  # Devices of the last loungeStatus, unparsed
         self.shorts_disconnected = False
         self.auto_play = True
         self.mute_ads = True
         self.skip_ads = True
+        self.queue = None
+        self.ad_breaks = AdBreakTracker(self.__skip_ad, self.background.spawn)
         if config:
             self.mute_ads = True
             self.skip_ads = True
             self.auto_play = config.auto_play
+            self.queue = QueueTracker(api_helper, config.queue_prefetch_count)
 
-    # Ensures that we still are subscribed to the lounge
+    # Ensures that we still are subscribed to the lounge: YouTube sends at least a message every 30 seconds
+    # (no-op or any other), the subscription is cancelled after 35 seconds without one
     async def _watchdog(self):
-        await asyncio.sleep(
-            35
-        )  # YouTube sends at least a message every 30 seconds (no-op or any other)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        while (remaining := max(self.last_event or 0, started) + 35 - loop.time()) > 0:
+            await asyncio.sleep(remaining)
         try:
             self.subscribe_task.cancel()
         except Exception:
@@ -51,107 +72,145 @@ class YtLoungeApi(pyytlounge.YtLoungeApi):
     # Subscribe to the lounge and start the watchdog
     async def subscribe_monitored(self, callback):
         self.callback = callback
-        try:
+        if self.subscribe_task_watchdog:
             self.subscribe_task_watchdog.cancel()
-        except:
-            pass  # No watchdog task
         self.subscribe_task = asyncio.create_task(super().subscribe(callback))
         self.subscribe_task_watchdog = asyncio.create_task(self._watchdog())
         return self.subscribe_task
 
     # Process a lounge subscription event
     def _process_event(self, event_id: int, event_type: str, args):
-        self.logger.debug(f"process_event({event_id}, {event_type}, {args})")
-        # (Re)start the watchdog
-        try:
-            self.subscribe_task_watchdog.cancel()
-        except:
-            pass
-        finally:
-            self.subscribe_task_watchdog = asyncio.create_task(self._watchdog())
-        # A bunch of events useful to detect ads playing, and the next video before it starts playing (that way we
-        # can get the segments)
-        if event_type == "onStateChange":
-            data = args[0]
-            # print(data)
-            # Unmute when the video starts playing
-            if self.mute_ads and data["state"] == "1":
-                create_task(self.mute(False, override=True))
-        elif event_type == "nowPlaying":
-            data = args[0]
-            # Unmute when the video starts playing
-            if self.mute_ads and data.get("state", "0") == "1":
-                create_task(self.mute(False, override=True))
-        elif event_type == "onAdStateChange":
-            data = args[0]
-            if data["adState"] == "0":
-                create_task(self.mute(False, override=True))
-            elif (
-                self.skip_ads and data["isSkipEnabled"] == "true"
-            ):  # YouTube uses strings for booleans
-                self.logger.info("Phát hiện phân đoạn quảng cáo, đã bỏ qua")
-                create_task(self.skip_ad())
-                create_task(self.mute(False, override=True))
-            elif (
-                self.mute_ads
-            ):  # Seen multiple other adStates, assuming they are all ads
-                create_task(self.mute(True, override=True))
-        # Manages volume, useful since YouTube wants to know the volume when unmuting (even if they already have it)
-        elif event_type == "onVolumeChanged":
-            self.volume_state = args[0]
-            pass
-        # Gets segments for the next video before it starts playing
-        elif event_type == "autoplayUpNext":
-            if len(args) > 0 and (
-                vid_id := args[0]["videoId"]
-            ):  # if video id is not empty
-                create_task(self.api_helper.get_segments(vid_id))
-
-        # #Used to know if an ad is skippable or not
-        elif event_type == "adPlaying":
-            data = args[0]
-            # Gets segments for the next video (after the ad) before it starts playing
-            if vid_id := data["contentVideoId"]:
-                create_task(self.api_helper.get_segments(vid_id))
-            elif (
-                self.skip_ads and data["isSkipEnabled"] == "true"
-            ):  # YouTube uses strings for booleans
-                self.logger.info("Phát hiện phân đoạn quảng cáo, đã bỏ qua")
-                create_task(self.skip_ad())
-                create_task(self.mute(False, override=True))
-            elif (
-                self.mute_ads
-            ):  # Seen multiple other adStates, assuming they are all ads
-                create_task(self.mute(True, override=True))
-
-        elif event_type == "loungeStatus":
-            data = args[0]
-            devices = json.loads(data["devices"])
-            for device in devices:
-                if device["type"] == "LOUNGE_SCREEN":
-                    device_info = json.loads(device.get("deviceInfo", "{}"))
-                    if device_info.get("clientName", "") in youtube_client_blacklist:
-                        self._sid = None
-                        self._gsession = None  # Force disconnect
-
-        elif event_type == "onSubtitlesTrackChanged":
-            if self.shorts_disconnected:
-                data = args[0]
-                video_id_saved = data.get("videoId", None)
-                self.shorts_disconnected = False
-                create_task(self.play_video(video_id_saved))
-        elif event_type == "loungeScreenDisconnected":
-            data = args[0]
-            if data["reason"] == "disconnectedByUserScreenInitiated":  # Short playing?
-                self.shorts_disconnected = True
-        elif event_type == "onAutoplayModeChanged":
-            create_task(self.set_auto_play_mode(self.auto_play))
-
+        # Only formatted when debug logging is on (and then, on the log writer thread)
+        self.logger.debug("process_event(%s, %s, %s)", event_id, event_type, args)
+        if self.recorder:
+            self.recorder.record(self.auth.screen_id, event_id, event_type, args)
+        self.last_event = asyncio.get_running_loop().time()  # Holds off the watchdog
+        handler = self._event_handlers.get(event_type)
+        if handler is not None and handler(self, args):
+            return  # Handled in full, pyytlounge has nothing left to do with it
         super()._process_event(event_id, event_type, args)
 
+    # A bunch of events useful to detect ads playing, and the next video before it starts playing (that way we
+    # can get the segments). Each handler takes the event's args, and returns True when pyytlounge doesn't
+    # need to process the event after it
+
+    def _on_state_change(self, args):
+        data = args[0]
+        # print(data)
+        # Unmute when the video starts playing
+        if data["state"] == "1":
+            self.ad_breaks.content_playing()
+            if self.mute_ads:
+                self.background.spawn(self.mute(False, override=True))
+
+    def _on_now_playing(self, args):
+        data = args[0]
+        # Unmute when the video starts playing
+        if data.get("state", "0") == "1":
+            self.ad_breaks.content_playing()
+            if self.mute_ads:
+                self.background.spawn(self.mute(False, override=True))
+        self.__warm_queue(data)
+
+    # The playlist or queue changed (videos added, removed or moved)
+    def _on_playlist_modified(self, args):
+        if args:
+            self.__warm_queue(args[0])
+
+    def _on_ad_state_change(self, args):
+        data = args[0]
+        if self.skip_ads:  # Skips the ad if it can be, or times the skip again
+            self.ad_breaks.ad_state_changed(data)
+        if data["adState"] == "0":
+            self.background.spawn(self.mute(False, override=True))
+        elif self.mute_ads and not self.ad_breaks.skipped:
+            # Seen multiple other adStates, assuming they are all ads (a skipped one is unmuted by __skip_ad)
+            self.background.spawn(self.mute(True, override=True))
+
+    # Manages volume, useful since YouTube wants to know the volume when unmuting (even if they already have it)
+    def _on_volume_changed(self, args):
+        self.volume_state = args[0]
+
+    # Gets segments for the next video before it starts playing
+    def _on_autoplay_up_next(self, args):
+        if len(args) > 0 and (vid_id := args[0]["videoId"]):  # if video id is not empty
+            self.background.spawn(self.api_helper.prefetch_segments(vid_id))
+
+    # #Used to know if an ad is skippable or not
+    def _on_ad_playing(self, args):
+        data = args[0]
+        if self.skip_ads:  # Skips the ad if it can be, otherwise times the skip
+            self.ad_breaks.ad_playing(data)
+        # Gets segments for the next video (after the ad) before it starts playing
+        if vid_id := data["contentVideoId"]:
+            self.background.spawn(self.api_helper.prefetch_segments(vid_id))
+        elif self.mute_ads and not self.ad_breaks.skipped:
+            # Seen multiple other adStates, assuming they are all ads (a skipped one is unmuted by __skip_ad)
+            self.background.spawn(self.mute(True, override=True))
+
+    # Sent over and over with the same devices: only a change gets parsed, and only the deviceInfo of the
+    # screens. Does what pyytlounge would (screen name and device info) on top of checking the client
+    def _on_lounge_status(self, args):
+        raw = args[0]["devices"]
+        if raw == self.lounge_status:
+            return True
+        screens = [i for i in json.loads(raw) if i["type"] == "LOUNGE_SCREEN"]
+        device_infos = [json.loads(i.get("deviceInfo") or "{}") for i in screens]
+        if screens:
+            self._screen_name = screens[0]["name"]
+            self._device_info = device_infos[0]
+        if any(
+            i.get("clientName", "") in youtube_client_blacklist for i in device_infos
+        ):
+            self._sid = None
+            self._gsession = None  # Force disconnect
+            self.lounge_status = None  # Checked again once reconnected
+        else:
+            self.lounge_status = raw
+        return True
+
+    def _on_subtitles_track_changed(self, args):
+        if self.shorts_disconnected:
+            data = args[0]
+            video_id_saved = data.get("videoId", None)
+            self.shorts_disconnected = False
+            self.background.spawn(self.play_video(video_id_saved))
+
+    def _on_lounge_screen_disconnected(self, args):
+        data = args[0]
+        if data["reason"] == "disconnectedByUserScreenInitiated":  # Short playing?
+            self.shorts_disconnected = True
+
+    def _on_autoplay_mode_changed(self, args):
+        self.background.spawn(self.set_auto_play_mode(self.auto_play))
+
+    _event_handlers = {
+        "onStateChange": _on_state_change,
+        "nowPlaying": _on_now_playing,
+        "playlistModified": _on_playlist_modified,
+        "onAdStateChange": _on_ad_state_change,
+        "onVolumeChanged": _on_volume_changed,
+        "autoplayUpNext": _on_autoplay_up_next,
+        "adPlaying": _on_ad_playing,
+        "loungeStatus": _on_lounge_status,
+        "onSubtitlesTrackChanged": _on_subtitles_track_changed,
+        "loungeScreenDisconnected": _on_lounge_screen_disconnected,
+        "onAutoplayModeChanged": _on_autoplay_mode_changed,
+    }
+
+    async def __skip_ad(self):
+        self.logger.info("Phát hiện phân đoạn quảng cáo, đã bỏ qua")
+        await self.skip_ad()
+        await self.mute(False, override=True)
+
+    # Gets segments for the next videos of the playlist or queue
+    def __warm_queue(self, data):
+        if self.queue and (warm := self.queue.update(data)):
+            self.background.spawn(warm)
+
     # Set the volume to a specific value (0-100)
     async def set_volume(self, volume: int) -> None:
-        await super()._command("setVolume", {"volume": volume})
+        await self._command("setVolume", {"volume": volume})
 
     # Mute or unmute the device (if the device already is in the desired state, nothing happens)
     # mute: True to mute, False to unmute
@@ -165,13 +224,13 @@ class YtLoungeApi(pyytlounge.YtLoungeApi):
         if override or not (self.volume_state.get("muted", "false") == mute_str):
             self.volume_state["muted"] = mute_str
             # YouTube wants the volume when unmuting, so we send it
-            await super()._command(
+            await self._command(
                 "setVolume",
                 {"volume": self.volume_state.get("volume", 100), "muted": mute_str},
             )
 
     async def set_auto_play_mode(self, enabled: bool):
-        await super()._command(
+        await self._command(
             "setAutoplayMode", {"autoplayMode": "ENABLED" if enabled else "DISABLED"}
         )
 
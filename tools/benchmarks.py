@@ -0,0 +1,547 @@
+"""Offline micro-benchmarks for the hot paths, with fixed (seeded) fixtures.
+
+    python -m tools.benchmarks [--filter NAME] [--json results.json] [--compare baseline.json]
+
+With --compare, every benchmark whose median got slower than the baseline by more than --threshold is
+reported and the exit code is 1, so it can gate a deployment.
+"""
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from SkipAdsTV import api_helpers, main, ytlounge
+from SkipAdsTV.background_tasks import BackgroundTasks
+from SkipAdsTV.conditional_ttl_cache import AsyncConditionalTTL
+from SkipAdsTV.logging_setup import TEXT_FORMAT, setup_logging
+from SkipAdsTV.segment_buckets import SegmentBucket
+
+BENCHMARKS = {}  # name -> (function, iterations)
+PEAK_MEMORY = {}  # name -> function returning the peak memory of one operation, bytes
+
+
+def benchmark(name, number=1000):
+    """Registers func(number) -> seconds taken by `number` operations"""
+
+    def decorator(func):
+        BENCHMARKS[name] = (func, number)
+        return func
+
+    return decorator
+
+
+def peak_memory(name):
+    """Registers func() -> bytes allocated at the peak of one operation, reported next to the timing"""
+
+    def decorator(func):
+        PEAK_MEMORY[name] = func
+        return func
+
+    return decorator
+
+
+def traced_peak(operation):
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        operation()
+        return tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+
+# Fixtures
+
+
+def segments_response(vid_id, count, seed=0, overlap=False):
+    """A skipSegments entry for one video, with `count` segments"""
+    rng = random.Random(f"{seed}-{vid_id}-{count}")
+    segments = []
+    position = 0.0
+    for i in range(count):
+        length = rng.uniform(5, 60)
+        start = rng.uniform(0, 3600) if overlap else position + rng.uniform(0, 120)
+        segments.append(
+            {
+                "category": "sponsor",
+                "actionType": "skip",
+                "segment": [round(start, 3), round(start + length, 3)],
+                "UUID": f"{vid_id}-{i:04}",
+                "locked": rng.choice((0, 1)),
+                "votes": rng.randint(-1, 50),
+                "videoDuration": 3700,
+            }
+        )
+        position = start + length
+    return {"videoID": vid_id, "segments": segments}
+
+
+def prefix_response(num_videos=300, segments_per_video=6):
+    """A skipSegments/{prefix} body for a busy prefix, and the id of a video in the middle of it"""
+    entries = [
+        segments_response(f"vid{i:08}", segments_per_video) for i in range(num_videos)
+    ]
+    body = json.dumps(entries, separators=(",", ":")).encode("utf-8")
+    return body, entries[num_videos // 2]["videoID"]
+
+
+def lounge_status(num_devices=30):
+    devices = []
+    for i in range(num_devices):
+        device_info = {
+            "brand": "Brand",
+            "model": f"Model {i}",
+            "year": 2020,
+            "os": "Android",
+            "osVersion": "11",
+            "chipset": "chipset",
+            "clientName": "TVHTML5" if i == 0 else "MWEB",
+            "dialAdditionalDataSupportLevel": "full",
+            "mdxDialServerType": "MDX_DIAL_SERVER_TYPE_IN_APP",
+        }
+        devices.append(
+            {
+                "app": "lb-v4",
+                "capabilities": "dsp,mic,dpa,ntb,vsp,mus",
+                "clientName": "tvhtml5",
+                "experiments": "",
+                "name": f"Device {i}",
+                "id": f"{i:032x}",
+                "type": "LOUNGE_SCREEN" if i == 0 else "REMOTE_CONTROL",
+                "hasCc": "true",
+                "localChannelEncryptionKey": "k" * 44,
+                "deviceContext": "user_agent=dunno&window_width_points=&window_height_points=&os_name=android&ms=",
+                "theme": "cl",
+                "deviceInfo": json.dumps(device_info),
+            }
+        )
+    return {"devices": json.dumps(devices), "queueId": "RQ" + "a" * 30}
+
+
+LOUNGE_EVENTS = {
+    "onStateChange": {"currentTime": "42.1", "duration": "600", "state": "1"},
+    "nowPlaying": {
+        "videoId": "dQw4w9WgXcQ",
+        "currentTime": "0",
+        "duration": "600",
+        "state": "1",
+        "listId": "RQ" + "a" * 30,
+        "currentIndex": "0",
+    },
+    "onAdStateChange": {"adState": "1", "isSkipEnabled": "true"},
+    "onVolumeChanged": {"volume": "50", "muted": "false"},
+    "autoplayUpNext": {"videoId": "dQw4w9WgXcQ"},
+    "adPlaying": {"contentVideoId": "", "isSkipEnabled": "false"},
+    "loungeStatus": lounge_status(),
+    "onSubtitlesTrackChanged": {"videoId": "dQw4w9WgXcQ"},
+    "loungeScreenDisconnected": {"reason": "disconnectedByUser"},
+    "onAutoplayModeChanged": {"autoplayMode": "ENABLED"},
+    "noop": None,
+}
+
+
+# A stand-in for aiohttp.ClientSession that answers every GET with the same JSON
+class FakeSession:
+    def __init__(self, data):
+        self.data = data
+
+    def get(self, url, **kwargs):
+        return FakeResponse(self.data)
+
+    def request(self, method, url, **kwargs):
+        return FakeResponse(self.data if method == "GET" else None)
+
+
+class FakeResponse:
+    status = 200
+
+    def __init__(self, data):
+        self.data = data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    headers = {}
+
+    async def json(self):
+        return copy.deepcopy(self.data)
+
+    async def read(self):
+        return json.dumps(self.data).encode("utf-8")
+
+    async def text(self):
+        return json.dumps(self.data)
+
+
+def fake_config(num_devices=1):
+    return SimpleNamespace(
+        apikey="",
+        skip_categories=["sponsor", "selfpromo", "intro", "outro"],
+        channel_whitelist=[],
+        data_dir=None,
+        skip_count_tracking=True,
+        auto_play=True,
+        sponsorblock_apis=["http://127.0.0.1/api/"],
+        sponsorblock_timeout=5,
+        sponsorblock_hedge=False,
+        sponsorblock_concurrency=4,
+        hash_prefix_length=4,
+        hash_prefix_adaptive=False,
+        hash_prefix_max_length=5,
+        segment_ttl_policy="adaptive",
+        max_background_tasks=32,
+        queue_prefetch_count=3,
+        queue_prefetch_budget=30,
+        devices=[None] * num_devices,
+    )
+
+
+# Benchmarks
+
+
+def _process_segments(responses):
+    copies = copy.deepcopy(responses)
+    start = time.perf_counter()
+    for response in copies:
+        api_helpers.ApiHelper.process_segments(response)
+    return time.perf_counter() - start
+
+
+@benchmark("process_segments.realistic", number=2000)
+def bench_process_segments_realistic(number):
+    return _process_segments(
+        [segments_response(f"vid{i % 50}", 1 + i % 8) for i in range(number)]
+    )
+
+
+@benchmark("process_segments.adversarial", number=20)
+def bench_process_segments_adversarial(number):
+    # Hundreds of overlapping segments: worst case for the nested merge loops
+    return _process_segments(
+        [segments_response(f"vid{i}", 300, overlap=True) for i in range(number)]
+    )
+
+
+def _ttl_benchmark(number, time_to_live, keys):
+    @api_helpers.list_to_tuple
+    @AsyncConditionalTTL(time_to_live=time_to_live, maxsize=10)
+    async def cached(vid_id, categories):
+        return ["segment"], False
+
+    categories = ["sponsor", "selfpromo", "intro"]
+
+    async def run():
+        await cached(keys[0], categories)  # Warm up
+        start = time.perf_counter()
+        for i in range(number):
+            await cached(keys[i % len(keys)], categories)
+        return time.perf_counter() - start
+
+    return asyncio.run(run())
+
+
+@benchmark("conditional_ttl.hit", number=20000)
+def bench_ttl_hit(number):
+    return _ttl_benchmark(number, 300, ["dQw4w9WgXcQ"])
+
+
+@benchmark("conditional_ttl.miss", number=20000)
+def bench_ttl_miss(number):
+    return _ttl_benchmark(number, 300, [f"vid{i}" for i in range(100)])
+
+
+@benchmark("conditional_ttl.expiry", number=20000)
+def bench_ttl_expiry(number):
+    return _ttl_benchmark(number, 0.000001, ["dQw4w9WgXcQ"])
+
+
+@benchmark("api_helper.get_segments.hit", number=20000)
+def bench_get_segments_hit(number):
+    # The decorated method, keyed on the video id only (skip_args=1)
+    async def run():
+        vid_id = "dQw4w9WgXcQ"
+        response = [segments_response(vid_id, 4)]
+        api_helper = api_helpers.ApiHelper(fake_config(), FakeSession(response))
+        await api_helper.get_segments(vid_id)
+        start = time.perf_counter()
+        for _ in range(number):
+            await api_helper.get_segments(vid_id)
+        return time.perf_counter() - start
+
+    return asyncio.run(run())
+
+
+def _find_with_json_loads(body, vid_id):
+    for i in json.loads(body):
+        if i["videoID"] == vid_id:
+            return i
+    return None
+
+
+def _find_with_bucket(body, vid_id):
+    return SegmentBucket(body).get(vid_id)
+
+
+def _prefix_response_benchmark(find, number):
+    body, vid_id = prefix_response()
+    start = time.perf_counter()
+    for _ in range(number):
+        find(body, vid_id)
+    return time.perf_counter() - start
+
+
+@benchmark("prefix_response.json_loads", number=200)
+def bench_prefix_json_loads(number):
+    # What get_segments used to do: decode everything, then search
+    return _prefix_response_benchmark(_find_with_json_loads, number)
+
+
+@benchmark("prefix_response.bucket", number=200)
+def bench_prefix_bucket(number):
+    return _prefix_response_benchmark(_find_with_bucket, number)
+
+
+@peak_memory("prefix_response.json_loads")
+def memory_prefix_json_loads():
+    body, vid_id = prefix_response()
+    return traced_peak(lambda: _find_with_json_loads(body, vid_id))
+
+
+@peak_memory("prefix_response.bucket")
+def memory_prefix_bucket():
+    body, vid_id = prefix_response()
+    return traced_peak(lambda: _find_with_bucket(body, vid_id))
+
+
+@benchmark("device_listener.time_to_segment", number=20000)
+def bench_time_to_segment(number):
+    async def skip(time_to, position, uuids):
+        pass
+
+    listener = SimpleNamespace(offset=0.1, skip=skip)
+    segments, _ = api_helpers.ApiHelper.process_segments(
+        segments_response("dQw4w9WgXcQ", 30)
+    )
+    positions = [random.Random(i).uniform(0, 3600) for i in range(100)]
+
+    async def run():
+        time_start = asyncio.get_running_loop().time()
+        start = time.perf_counter()
+        for i in range(number):
+            await main.DeviceListener.time_to_segment(
+                listener, segments, positions[i % 100], time_start
+            )
+        return time.perf_counter() - start
+
+    return asyncio.run(run())
+
+
+def _process_event_benchmark(event_type, number, payloads=None):
+    """payloads: the events' data, in turn (the same one every time by default)"""
+    async def command(command, command_parameters=None):
+        return True
+
+    async def get_segments(vid_id):
+        return [], True
+
+    async def get_playlist_items(list_id, count):
+        return []
+
+    async def prefetch_queue(vid_ids):
+        pass
+
+    logger = logging.getLogger("SkipAdsTV.benchmarks")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    if payloads is None:
+        payloads = [LOUNGE_EVENTS[event_type]]
+    events = [[i] if i else [] for i in payloads]
+
+    async def run():
+        api_helper = SimpleNamespace(
+            get_segments=get_segments,
+            prefetch_segments=get_segments,
+            get_playlist_items=get_playlist_items,
+            prefetch_queue=prefetch_queue,
+        )
+        # Every event's tasks are measured, none dropped
+        lounge_controller = ytlounge.YtLoungeApi(
+            "screen",
+            fake_config(),
+            api_helper,
+            logger,
+            background=BackgroundTasks(logger, limit=number),
+        )
+        lounge_controller._command = command
+        elapsed = 0.0
+        for batch in range(0, number, 100):
+            lounge_controller._sid = lounge_controller._gsession = "sid"
+            start = time.perf_counter()
+            for event_id in range(batch, min(batch + 100, number)):
+                lounge_controller._process_event(
+                    event_id, event_type, events[event_id % len(events)]
+                )
+            elapsed += time.perf_counter() - start
+            await asyncio.sleep(0)  # Let the tasks it created run, outside the timer
+        await lounge_controller.session.close()
+        return elapsed
+
+    return asyncio.run(run())
+
+
+for _event_type in LOUNGE_EVENTS:
+    benchmark(f"ytlounge.process_event.{_event_type}", number=5000)(
+        lambda number, event_type=_event_type: _process_event_benchmark(
+            event_type, number
+        )
+    )
+
+
+# Every loungeStatus lists different devices, none can be skipped
+@benchmark("ytlounge.process_event.loungeStatus.changing", number=5000)
+def bench_lounge_status_changing(number):
+    return _process_event_benchmark(
+        "loungeStatus", number, [lounge_status(30), lounge_status(29)]
+    )
+
+
+def _logging_benchmark(number, queued):
+    logger = logging.getLogger("SkipAdsTV")
+    saved = logger.handlers[:], logger.level, logger.propagate
+    with open(os.devnull, "w", encoding="utf-8") as devnull:
+        if queued:
+            listener = setup_logging(stream=devnull)
+        else:  # A StreamHandler writing (and formatting) on the event loop, like before
+            logger.handlers = [logging.StreamHandler(devnull)]
+            logger.handlers[0].setFormatter(logging.Formatter(TEXT_FORMAT))
+            logger.setLevel(logging.INFO)
+        device_logger = logger.getChild("Living room")
+        start = time.perf_counter()
+        for i in range(number):
+            device_logger.info("Đang bỏ qua: đoạn quảng cáo %s", i)
+        elapsed = time.perf_counter() - start
+        if queued:
+            listener.stop()
+    logger.handlers, logger.level, logger.propagate = saved
+    return elapsed
+
+
+@benchmark("logging.info.stream_handler", number=2000)
+def bench_logging_stream(number):
+    return _logging_benchmark(number, queued=False)
+
+
+@benchmark("logging.info.queued", number=2000)
+def bench_logging_queued(number):
+    # Only what's left on the event loop, the writer thread does the rest
+    return _logging_benchmark(number, queued=True)
+
+
+@benchmark("json.loads.lounge_status", number=2000)
+def bench_lounge_status_json(number):
+    data = LOUNGE_EVENTS["loungeStatus"]
+    start = time.perf_counter()
+    for _ in range(number):
+        for device in json.loads(data["devices"]):
+            json.loads(device.get("deviceInfo", "{}"))
+    return time.perf_counter() - start
+
+
+# Runner
+
+
+def run(names, repeat):
+    results = {}
+    for name in names:
+        func, number = BENCHMARKS[name]
+        timings = [func(number) / number for _ in range(repeat)]
+        results[name] = {
+            "iterations": number,
+            "repeat": repeat,
+            "median_us": round(statistics.median(timings) * 1e6, 4),
+            "min_us": round(min(timings) * 1e6, 4),
+            "stdev_us": round(statistics.pstdev(timings) * 1e6, 4),
+        }
+        line = (
+            f"{name:<45} {results[name]['median_us']:>12.3f} us"
+            f"  (min {results[name]['min_us']:.3f})"
+        )
+        if name in PEAK_MEMORY:
+            results[name]["peak_kib"] = round(PEAK_MEMORY[name]() / 1024, 1)
+            line += f"  peak {results[name]['peak_kib']:.1f} KiB"
+        print(line)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Prints the change against the baseline, returns the names that regressed"""
+    regressions = []
+    print(f"\n{'benchmark':<45} {'baseline':>12} {'now':>12} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, now = baseline[name]["median_us"], result["median_us"]
+        change = now / before - 1 if before else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<45} {before:>12.3f} {now:>12.3f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main_benchmarks():
+    parser = argparse.ArgumentParser(description="SkipAdsTV micro-benchmarks")
+    parser.add_argument(
+        "--filter", default="", help="only run benchmarks whose name contains this"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", metavar="FILE", help="write the results to FILE")
+    parser.add_argument(
+        "--compare", metavar="BASELINE", help="results file to compare against"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.15,
+        help="slowdown (fraction of the baseline) that counts as a regression",
+    )
+    args = parser.parse_args()
+
+    names = [i for i in BENCHMARKS if args.filter in i]
+    results = run(names, args.repeat)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "platform": platform.platform(),
+                    "results": results,
+                },
+                f,
+                indent=4,
+            )
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_benchmarks()
@@ -0,0 +1,379 @@
+"""Local stand-ins for the remote services the daemon talks to, for offline replays and benchmarks."""
+import asyncio
+import json
+import random
+from hashlib import sha256
+
+from aiohttp import web
+
+AD_SKIP_OFFSET = 5.0  # Seconds into an ad its skip button shows up
+
+
+def generate_segments(vid_id, duration=600):
+    """Deterministic, SponsorBlock-shaped segments for a video id (same id, same segments)"""
+    rng = random.Random(vid_id)
+    segments = []
+    position = rng.uniform(5, 60)
+    for i in range(rng.randint(1, 3)):
+        length = rng.uniform(8, 60)
+        if position + length >= duration:
+            break
+        segments.append(
+            {
+                "category": rng.choice(("sponsor", "selfpromo", "intro", "outro")),
+                "actionType": "skip",
+                "segment": [round(position, 3), round(position + length, 3)],
+                "UUID": sha256(f"{vid_id}-{i}".encode("utf-8")).hexdigest(),
+                "locked": rng.choice((0, 0, 1)),
+                "votes": rng.randint(-1, 50),
+                "videoDuration": duration,
+                "userID": "fake",
+                "description": "",
+            }
+        )
+        position += length + rng.uniform(30, 240)
+    return segments
+
+
+# Fake SponsorBlock API: serves skipSegments/<hash prefix> for a known set of videos and counts the
+# viewedVideoSponsorTime reports it receives
+class FakeSponsorBlock:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.videos = {}  # video id -> list of segments (API format)
+        self.segment_requests = 0
+        self.viewed_reports = []
+        self.error_status = None  # Answer every request with this status, to simulate an outage
+        self.etags = True  # Send an ETag and answer If-None-Match with 304, like a caching proxy
+        self.not_modified = 0
+        self.runner = None
+        self.base_url = None
+
+    def add_video(self, vid_id, segments=None):
+        self.videos[vid_id] = (
+            segments if segments is not None else generate_segments(vid_id)
+        )
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application()
+        app.router.add_get("/api/skipSegments/{prefix}", self.handle_skip_segments)
+        app.router.add_post("/api/viewedVideoSponsorTime/", self.handle_viewed)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        self.base_url = f"http://{host}:{port}/api/"
+        return self.base_url
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def handle_skip_segments(self, request):
+        self.segment_requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_status:
+            return web.Response(status=self.error_status)
+        prefix = request.match_info["prefix"]
+        categories = request.query.getall("category", [])
+        result = []
+        for vid_id, segments in self.videos.items():
+            vid_hash = sha256(vid_id.encode("utf-8")).hexdigest()
+            if not vid_hash.startswith(prefix):
+                continue
+            segments = [
+                i for i in segments if not categories or i["category"] in categories
+            ]
+            if segments:
+                result.append(
+                    {"videoID": vid_id, "hash": vid_hash, "segments": segments}
+                )
+        if not result:
+            # Same as the real API
+            return web.Response(status=404, text="Not Found")
+        body = json.dumps(result, separators=(",", ":")).encode("utf-8")
+        if not self.etags:
+            return web.Response(body=body, content_type="application/json")
+        etag = '"' + sha256(body).hexdigest()[:32] + '"'
+        if request.headers.get("If-None-Match") == etag:
+            self.not_modified += 1
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(
+            body=body, content_type="application/json", headers={"ETag": etag}
+        )
+
+    async def handle_viewed(self, request):
+        if self.error_status:
+            return web.Response(status=self.error_status)
+        self.viewed_reports.append(request.query.get("UUID"))
+        return web.Response(text="OK")
+
+
+def lounge_chunk(events):
+    """Frames events the way the lounge bind endpoint does: a length line, then the JSON chunk"""
+    payload = json.dumps(events, separators=(",", ":"))
+    return f"{len(payload) + 1}\n{payload}\n"
+
+
+# A TV on the fake lounge: plays videos from the catalog, with ads, pauses and seeks, and keeps score of
+# how well the daemon skipped the segments it went through
+class FakeScreen:
+    def __init__(self, screen_id, catalog, sponsorblock, seed=0):
+        self.screen_id = screen_id
+        self.sid = "sid-" + screen_id
+        self.catalog = catalog
+        self.sponsorblock = sponsorblock
+        self.rng = random.Random(f"{seed}-{screen_id}")
+        self.pending = []
+        self.wakeup = asyncio.Event()
+        self.subscriber = None
+        self.task = None
+        self.event_id = 3
+        self.events = 0
+        self.commands = 0
+        # Playback
+        self.video_id = ""
+        self.duration = 0.0
+        self.position = 0.0
+        self.position_time = 0.0
+        self.playing = False
+        self.segments = []
+        # Skip accuracy
+        self.expected = set()
+        self.skipped = set()
+        self.errors = []  # seconds the seek arrived after the segment start (negative: early)
+        # Ads: set when skipAd arrives after the skip button showed up
+        self.ad_skip = None
+        self.ad_skippable_at = 0.0
+        self.ad_seconds = []  # seconds every ad played after it could be skipped
+
+    def push(self, event_type, data=None):
+        self.pending.append([self.event_id, [event_type] + ([data] if data else [])])
+        self.event_id += 1
+        self.wakeup.set()
+
+    def now(self):
+        return asyncio.get_running_loop().time()
+
+    def current_time(self):
+        if not self.playing:
+            return self.position
+        return self.position + self.now() - self.position_time
+
+    def advance(self):
+        """Plays up to now, noting the segments whose start was played through"""
+        position = self.current_time()
+        for start, end in self.segments:
+            if self.position <= start < position:
+                self.expected.add((self.video_id, start))
+        self.position = position
+        self.position_time = self.now()
+
+    def jump(self, position):
+        self.advance()
+        self.position = position
+
+    def playback_state(self):
+        return {
+            "videoId": self.video_id,
+            "currentTime": str(round(self.current_time(), 3)),
+            "duration": str(round(self.duration, 3)),
+            "state": "1" if self.playing else "2",
+        }
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            vid_id = self.rng.choice(self.catalog)
+            if self.rng.random() < 0.3:
+                await self.play_ad(vid_id)
+            await self.play_video(vid_id, self.rng.uniform(60, 240))
+
+    async def play_ad(self, vid_id):
+        self.ad_skip = asyncio.Event()
+        self.ad_skippable_at = self.now() + AD_SKIP_OFFSET
+        self.push(
+            "adPlaying",
+            {
+                "adVideoId": f"ad-{self.event_id}",
+                "contentVideoId": vid_id,
+                "isSkippable": "true",
+                "isSkipEnabled": "false",
+                "currentTime": "0",
+                "skipTimeRemaining": str(AD_SKIP_OFFSET),
+                "adState": "1",
+            },
+        )
+        await asyncio.sleep(AD_SKIP_OFFSET)
+        self.push(
+            "onAdStateChange",
+            {"adState": "1", "isSkipEnabled": "true", "currentTime": str(AD_SKIP_OFFSET)},
+        )
+        try:  # Plays to its end unless it's skipped
+            await asyncio.wait_for(self.ad_skip.wait(), self.rng.uniform(1, 10))
+        except asyncio.TimeoutError:
+            pass
+        self.ad_seconds.append(self.now() - self.ad_skippable_at)
+        self.ad_skip = None
+        self.push("onAdStateChange", {"adState": "0", "isSkipEnabled": "false"})
+
+    async def play_video(self, vid_id, duration):
+        self.video_id = vid_id
+        self.duration = duration
+        self.segments = [
+            tuple(i["segment"]) for i in self.sponsorblock.videos.get(vid_id, [])
+        ]
+        self.position, self.position_time, self.playing = 0.0, self.now(), True
+        self.push("nowPlaying", self.playback_state())
+        upnext_sent = False
+        while (remaining := self.duration - self.current_time()) > 0:
+            await asyncio.sleep(min(self.rng.uniform(5, 20), remaining))
+            roll = self.rng.random()
+            if roll < 0.1:  # The user seeks somewhere
+                self.jump(self.rng.uniform(0, self.duration))
+                self.push("onStateChange", self.playback_state())
+            elif roll < 0.2:  # The user pauses for a bit
+                self.advance()
+                self.playing = False
+                self.push("onStateChange", self.playback_state())
+                await asyncio.sleep(self.rng.uniform(1, 5))
+                self.position_time, self.playing = self.now(), True
+                self.push("onStateChange", self.playback_state())
+            if not upnext_sent and self.duration - self.current_time() < 20:
+                upnext_sent = True
+                self.push("autoplayUpNext", {"videoId": self.rng.choice(self.catalog)})
+        self.advance()
+
+    def command(self, command, parameters):
+        self.commands += 1
+        if command == "seekTo":
+            new_time = float(parameters["req0_newTime"])
+            self.advance()
+            for start, end in self.segments:
+                if abs(end - new_time) < 0.01 and start - 2 <= self.position:
+                    self.expected.add((self.video_id, start))
+                    self.skipped.add((self.video_id, start))
+                    self.errors.append(self.position - start)
+            self.jump(new_time)
+            self.push("onStateChange", self.playback_state())
+        elif command == "skipAd":
+            # Too early and the TV ignores it
+            if self.ad_skip is not None and self.now() >= self.ad_skippable_at:
+                self.ad_skip.set()
+        elif command == "setVolume":
+            self.push(
+                "onVolumeChanged",
+                {
+                    "volume": str(parameters.get("req0_volume", 100)),
+                    "muted": parameters.get("req0_muted", "false"),
+                },
+            )
+
+    def stats(self):
+        return {
+            "events": self.events,
+            "commands": self.commands,
+            "expected": len(self.expected),
+            "skipped": len(self.skipped),
+            "errors": self.errors,
+            "ad_seconds": self.ad_seconds,
+        }
+
+
+# Fake YouTube lounge API: just enough of pairing/ and bc/bind for pyytlounge to link, connect, subscribe
+# and send commands to a fleet of FakeScreens
+class FakeLounge:
+    def __init__(self, screens):
+        self.screens = {i.screen_id: i for i in screens}
+        self.by_sid = {i.sid: i for i in screens}
+        self.runner = None
+        self.base_url = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application()
+        app.router.add_post(
+            "/api/lounge/pairing/get_lounge_token_batch", self.handle_token
+        )
+        app.router.add_post(
+            "/api/lounge/pairing/get_screen_availability", self.handle_availability
+        )
+        app.router.add_post("/api/lounge/bc/bind", self.handle_bind_post)
+        app.router.add_get("/api/lounge/bc/bind", self.handle_subscribe)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        self.base_url = f"http://{host}:{port}/api/lounge"
+        return self.base_url
+
+    async def stop(self):
+        for screen in self.screens.values():
+            if screen.task:
+                screen.task.cancel()
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def handle_token(self, request):
+        data = await request.post()
+        screen_id = data["screen_ids"]
+        return web.json_response(
+            {"screens": [{"screenId": screen_id, "loungeToken": "token-" + screen_id}]}
+        )
+
+    async def handle_availability(self, request):
+        return web.json_response({"screens": [{"status": "online"}]})
+
+    async def handle_bind_post(self, request):
+        data = await request.post()
+        screen = self.by_sid.get(request.query.get("SID"))
+        if screen is None:  # Connect
+            screen = self.screens.get(data.get("id"))
+            if screen is None:
+                return web.Response(status=401, text="Expired")
+            devices = [
+                {
+                    "type": "LOUNGE_SCREEN",
+                    "name": screen.screen_id,
+                    "deviceInfo": json.dumps({"clientName": "TVHTML5"}),
+                }
+            ]
+            events = [
+                [0, ["c", screen.sid, "", 8]],
+                [1, ["S", "gsession-" + screen.screen_id]],
+                [2, ["loungeStatus", {"devices": json.dumps(devices)}]],
+            ]
+            return web.Response(text=lounge_chunk(events))
+        if data.get("TYPE") != "terminate":
+            screen.command(data.get("req0__sc"), data)
+        return web.Response(text="ok")
+
+    async def handle_subscribe(self, request):
+        screen = self.by_sid.get(request.query.get("SID"))
+        if screen is None:
+            return web.Response(status=400, reason="Unknown SID")
+        response = web.StreamResponse()
+        response.content_type = "text/plain"
+        await response.prepare(request)
+        token = screen.subscriber = object()
+        screen.start()
+        try:
+            while screen.subscriber is token:
+                if not screen.pending:
+                    screen.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(screen.wakeup.wait(), 20)
+                    except asyncio.TimeoutError:
+                        screen.push("noop")
+                    continue
+                events, screen.pending = screen.pending, []
+                screen.events += len(events)
+                await response.write(lounge_chunk(events).encode("utf-8"))
+        except ConnectionResetError:
+            pass
+        return response
@@ -0,0 +1,106 @@
+"""Checks that the daemon's runtime path (helpers.app_start -> Config.validate -> main.main) only imports
+what it uses, and that its import time and resident memory stay within budget:
+
+    python -m tools.import_check [--max-import-ms 400] [--max-rss-mb 45] [--verbose]
+
+Exits 1 when a setup-only module gets imported or a budget is exceeded.
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+# Only needed by the setup flows
+FORBIDDEN_MODULES = (
+    "SkipAdsTV.config_setup",
+    "SkipAdsTV.setup_wizard",
+    "SkipAdsTV.dial_client",
+    "textual",
+    "textual_slider",
+    "rich",
+    "ssdp",
+    "xmltodict",
+)
+
+# Runs in a fresh interpreter, doing the imports app_start does on its way to main.main
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+from SkipAdsTV import helpers
+from SkipAdsTV import main
+elapsed = time.perf_counter() - start
+rss = 0
+try:
+    with open("/proc/self/status", "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) / 1024
+except OSError:
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(json.dumps({"import_ms": elapsed * 1000, "rss_mb": rss, "modules": sorted(sys.modules)}))
+"""
+
+
+def probe():
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout), result.stderr
+
+
+def slowest_imports(importtime_output, count=15):
+    """Top-level packages by cumulative import time, from -X importtime's output"""
+    imports = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if not name.startswith("  "):  # Only the ones imported directly by the probe
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main_import_check():
+    parser = argparse.ArgumentParser(description="SkipAdsTV runtime import check")
+    parser.add_argument("--max-import-ms", type=float, default=400)
+    parser.add_argument("--max-rss-mb", type=float, default=45)
+    parser.add_argument(
+        "--verbose", action="store_true", help="list the slowest imports"
+    )
+    args = parser.parse_args()
+
+    result, importtime_output = probe()
+    failures = []
+    forbidden = [
+        i
+        for i in FORBIDDEN_MODULES
+        if any(j == i or j.startswith(i + ".") for j in result["modules"])
+    ]
+    if forbidden:
+        failures.append("setup-only modules imported: " + ", ".join(forbidden))
+    if result["import_ms"] > args.max_import_ms:
+        failures.append(
+            f"import time {result['import_ms']:.1f} ms > {args.max_import_ms} ms"
+        )
+    if result["rss_mb"] > args.max_rss_mb:
+        failures.append(f"RSS {result['rss_mb']:.1f} MiB > {args.max_rss_mb} MiB")
+
+    print(
+        f"import time {result['import_ms']:.1f} ms, RSS {result['rss_mb']:.1f} MiB,"
+        f" {len(result['modules'])} modules"
+    )
+    if args.verbose:
+        for cumulative, name in slowest_imports(importtime_output):
+            print(f"{cumulative / 1000:>10.1f} ms  {name}")
+    for failure in failures:
+        print("FAIL:", failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_import_check()
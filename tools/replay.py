@@ -0,0 +1,213 @@
+"""Replays a lounge event recording (made with `--record`) through DeviceListener on a virtual clock.
+
+Every command the daemon would have sent to the TV (seekTo, setVolume, skipAd...) is stubbed out and
+reported with the (virtual) time it would have been sent at, so changes to the skip scheduling and to the
+caches can be compared on real traces with reproducible numbers. The caches, the prefetch budget and the
+viewed reports' dedupe run on the virtual clock too:
+
+    python -m tools.replay events.jsonl [--segments segments.json] [--json report.json]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import selectors
+from types import SimpleNamespace
+
+import aiohttp
+
+from SkipAdsTV import api_helpers, constants, main
+from SkipAdsTV.event_recorder import read_events
+
+from .fake_servers import FakeSponsorBlock
+
+# Events whose payload names a video the daemon may look up segments for
+VIDEO_ID_FIELDS = {
+    "nowPlaying": "videoId",
+    "onStateChange": "videoId",
+    "autoplayUpNext": "videoId",
+    "adPlaying": "contentVideoId",
+}
+
+
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.0
+
+
+# Selector that, instead of blocking until the next timer, jumps the virtual clock forward to it.
+# Local sockets (the fake servers) still get a short real grace period, so their replies arrive before
+# time moves on
+class VirtualSelector(selectors.DefaultSelector):
+    def __init__(self, clock, grace=0.001):
+        super().__init__()
+        self.clock = clock
+        self.grace = grace
+
+    def select(self, timeout=None):
+        ready = super().select(0)
+        if ready or timeout == 0:
+            return ready
+        ready = super().select(self.grace)
+        if ready or timeout is None:
+            return ready or super().select(None)
+        self.clock.now += timeout
+        return []
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock=None):
+        self.clock = clock or VirtualClock()
+        super().__init__(VirtualSelector(self.clock))
+
+    def time(self):
+        return self.clock.now
+
+
+def load_segments(path):
+    """Segments fixture: {"videoId": [SponsorBlock segment, ...], ...}"""
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+async def replay(records, segments=None, offset=0, tail=600.0):
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    sponsorblock = FakeSponsorBlock()
+    for record in records:
+        field = VIDEO_ID_FIELDS.get(record[3])
+        if field and record[4] and (vid_id := record[4][0].get(field)):
+            if segments is None:
+                sponsorblock.add_video(vid_id)
+            elif vid_id in segments:
+                sponsorblock.add_video(vid_id, segments[vid_id])
+    await sponsorblock.start()
+
+    screen_ids = list(dict.fromkeys(record[1] for record in records))
+    config = SimpleNamespace(
+        apikey="",
+        skip_categories=[i[1] for i in constants.skip_categories],
+        channel_whitelist=[],
+        data_dir=None,
+        skip_count_tracking=True,
+        auto_play=True,
+        sponsorblock_apis=[sponsorblock.base_url],
+        sponsorblock_timeout=5,
+        sponsorblock_hedge=False,
+        sponsorblock_concurrency=4,
+        hash_prefix_length=4,
+        hash_prefix_adaptive=False,
+        hash_prefix_max_length=5,
+        segment_ttl_policy="adaptive",
+        max_background_tasks=32,
+        queue_prefetch_count=3,
+        queue_prefetch_budget=30,
+        devices=[
+            SimpleNamespace(screen_id=i, name=i, offset=offset / 1000)
+            for i in screen_ids
+        ],
+    )
+    commands = []
+    web_session = aiohttp.ClientSession()
+    # The caches expire (and get revalidated) on the replayed timeline
+    api_helper = api_helpers.ApiHelper(config, web_session, clock=loop.time)
+    listeners = {}
+    for device in config.devices:
+        listener = main.DeviceListener(api_helper, config, device, False, web_session)
+        lounge_controller = listener.lounge_controller
+        lounge_controller._sid = lounge_controller._gsession = "replay"
+        lounge_controller.auth.lounge_id_token = "replay"
+        lounge_controller._command = _stub_command(commands, device.screen_id, start)
+        listeners[device.screen_id] = listener
+    logging.getLogger("SkipAdsTV").setLevel(logging.WARNING)
+
+    viewed_reports = asyncio.create_task(api_helper.viewed_reports.run())
+    first_timestamp = records[0][0] if records else 0
+    for timestamp, screen_id, event_id, event_type, args in records:
+        await asyncio.sleep(timestamp - first_timestamp - (loop.time() - start))
+        listener = listeners[screen_id]
+        lounge_controller = listener.lounge_controller
+        # Same as pyytlounge's subscribe loop
+        pre_state_update = lounge_controller.state_update
+        lounge_controller._process_events([[event_id, [event_type, *args]]])
+        if pre_state_update != lounge_controller.state_update:
+            await listener(lounge_controller.state)
+    await asyncio.sleep(tail)  # Let the pending skips fire
+
+    for listener in listeners.values():
+        # The session is made up, there's nothing to leave on YouTube's side
+        listener.lounge_controller._sid = listener.lounge_controller._gsession = None
+        await listener.cancel()
+    viewed_reports.cancel()
+    await web_session.close()
+    await sponsorblock.stop()
+    return {
+        "events": len(records),
+        "duration": round(loop.time() - start, 3),
+        "commands": commands,
+        "segment_requests": sponsorblock.segment_requests,
+        "viewed_reports": len(sponsorblock.viewed_reports),
+    }
+
+
+def _stub_command(commands, screen_id, start):
+    async def command(command, command_parameters=None):
+        commands.append(
+            {
+                "time": round(asyncio.get_running_loop().time() - start, 3),
+                "device": screen_id,
+                "command": command,
+                "parameters": command_parameters or {},
+            }
+        )
+        return True
+
+    return command
+
+
+def main_replay():
+    parser = argparse.ArgumentParser(description="Replay a SkipAdsTV event recording")
+    parser.add_argument("recording", help="file written by --record")
+    parser.add_argument(
+        "--segments",
+        help="JSON file with SponsorBlock segments per video id (default: generated)",
+    )
+    parser.add_argument(
+        "--offset", type=int, default=0, help="device offset in milliseconds"
+    )
+    parser.add_argument(
+        "--tail",
+        type=float,
+        default=600,
+        help="seconds to keep the clock running after the last event",
+    )
+    parser.add_argument("--json", metavar="FILE", help="write the report to FILE")
+    args = parser.parse_args()
+
+    records = list(read_events(args.recording))
+    segments = load_segments(args.segments) if args.segments else None
+    loop = VirtualClockLoop()
+    asyncio.set_event_loop(loop)
+    try:
+        report = loop.run_until_complete(
+            replay(records, segments, args.offset, args.tail)
+        )
+    finally:
+        loop.close()
+
+    for i in report["commands"]:
+        print(
+            f"{i['time']:>10.3f}s  {i['device']}  {i['command']} {i['parameters']}"
+        )
+    print(
+        f"{report['events']} events replayed over {report['duration']}s (virtual):"
+        f" {len(report['commands'])} commands, {report['segment_requests']} segment"
+        f" requests, {report['viewed_reports']} viewed reports"
+    )
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main_replay()
@@ -0,0 +1,273 @@
+"""End-to-end checks of the SponsorBlock paths that only kick in when something goes wrong or gets old
+(outages, slow servers, expired caches), run against local FakeSponsorBlock servers:
+
+    python -m tools.scenarios [--filter NAME]
+
+Exits 1 when a scenario doesn't behave as expected.
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+import aiohttp
+
+from SkipAdsTV import api_helpers
+from SkipAdsTV.sponsorblock_client import SponsorBlockClient, SponsorBlockUnavailable
+
+from .benchmarks import fake_config
+from .fake_servers import FakeSponsorBlock
+from .simulator import make_catalog
+
+SCENARIOS = {}
+
+
+class ScenarioFailed(Exception):
+    pass
+
+
+def scenario(name):
+    def decorator(func):
+        SCENARIOS[name] = func
+        return func
+
+    return decorator
+
+
+def check(condition, message):
+    if not condition:
+        raise ScenarioFailed(message)
+
+
+async def start_servers(count, catalog):
+    servers = [FakeSponsorBlock() for _ in range(count)]
+    for server in servers:
+        for vid_id in catalog:
+            server.add_video(vid_id)
+        await server.start()
+    return servers
+
+
+def make_api_helper(server, web_session):
+    config = fake_config()
+    config.sponsorblock_apis = [server.base_url]
+    api_helper = api_helpers.ApiHelper(config, web_session)
+    # The segments cache is shared by every ApiHelper, empty it of the previous scenarios' ones
+    api_helper.segments_cache.invalidate()
+    return api_helper
+
+
+def expire_buckets(api_helper):
+    """Makes the cached segments and buckets of an ApiHelper expire, as if their TTLs were over"""
+    api_helper.segments_cache.invalidate()
+    buckets = api_helper.segment_buckets.buckets
+    for prefix, (bucket, _) in buckets.items():
+        buckets[prefix] = (bucket, 0)
+
+
+def count_calls(obj, name):
+    """Replaces a method of obj by one counting its calls in the returned list"""
+    calls = []
+    method = getattr(obj, name)
+
+    def counted(*args, **kwargs):
+        calls.append(args)
+        return method(*args, **kwargs)
+
+    setattr(obj, name, counted)
+    return calls
+
+
+# Scenarios
+
+
+@scenario("sponsorblock.failover")
+async def failover():
+    """The primary fails: requests go to the mirror. Both fail: their breakers open after 3 failures and
+    requests fail fast, a single trial request is let through once reset_timeout is over, and the
+    primary's breaker closes again once it's back"""
+    primary, mirror = await start_servers(2, make_catalog(0, 10))
+    try:
+        async with aiohttp.ClientSession() as web_session:
+            client = SponsorBlockClient(
+                web_session,
+                [primary.base_url, mirror.base_url],
+                failure_threshold=3,
+                reset_timeout=0.5,
+            )
+            primary_state = client.mirrors[0]
+            for _ in range(3):  # Healthy: the primary answers (ties go to the first one)
+                response = await client.request("GET", "skipSegments/abcd")
+            check(response.base_url == primary.base_url, "primary not used first")
+
+            primary.error_status = 503
+            response = await client.request("GET", "skipSegments/abcd")
+            check(response.base_url == mirror.base_url, "no failover")
+            check(primary_state.failures == 1, "primary failure not counted")
+
+            mirror.error_status = 503
+            for _ in range(5):  # Both failing, until both breakers are open
+                try:
+                    await client.request("GET", "skipSegments/abcd")
+                    check(False, "answered while every server fails")
+                except SponsorBlockUnavailable:
+                    pass
+            check(
+                [i.state for i in client.mirrors] == ["open", "open"],
+                "breakers not open after 3 failures",
+            )
+            requests = primary.segment_requests + mirror.segment_requests
+            start = time.perf_counter()
+            try:
+                await client.request("GET", "skipSegments/abcd")
+                check(False, "no SponsorBlockUnavailable with every breaker open")
+            except SponsorBlockUnavailable:
+                pass
+            check(time.perf_counter() - start < 0.01, "didn't fail fast")
+            check(
+                primary.segment_requests + mirror.segment_requests == requests,
+                "open breaker still used",
+            )
+
+            await asyncio.sleep(0.6)  # Half-open: one trial each, which fail and reopen them
+            try:
+                await client.request("GET", "skipSegments/abcd")
+            except SponsorBlockUnavailable:
+                pass
+            check(
+                primary.segment_requests + mirror.segment_requests == requests + 2,
+                "not a single trial request per server",
+            )
+            check(primary_state.state == "open", "failed trial didn't reopen it")
+
+            primary.error_status = None
+            await asyncio.sleep(0.6)
+            response = await client.request("GET", "skipSegments/abcd")
+            check(response.base_url == primary.base_url, "recovered primary not used")
+            check(primary_state.state == "closed", "breaker not closed on recovery")
+    finally:
+        await primary.stop()
+        await mirror.stop()
+
+
+@scenario("sponsorblock.hedging")
+async def hedging():
+    """The primary gets slow: with hedging, the mirror is asked too once the primary is slower than usual,
+    and its answer is used"""
+    primary, mirror = await start_servers(2, make_catalog(0, 10))
+    try:
+        async with aiohttp.ClientSession() as web_session:
+            client = SponsorBlockClient(
+                web_session,
+                [primary.base_url, mirror.base_url.rstrip("/")],  # Either way
+                hedge=True,
+                hedge_min_samples=5,
+            )
+            for _ in range(5):  # The primary's usual latency
+                await client.request("GET", "skipSegments/abcd")
+            primary.latency = 1.0
+            start = time.perf_counter()
+            response = await client.request("GET", "skipSegments/abcd")
+            elapsed = time.perf_counter() - start
+            check(response.base_url == mirror.base_url, "hedged answer not used")
+            check(client.hedged_requests == 1, "no hedged request")
+            check(elapsed < 0.5, f"waited on the slow primary ({elapsed:.2f} s)")
+
+            start = time.perf_counter()
+            response = await client.request(
+                "POST", "viewedVideoSponsorTime/", hedge=False, params={"UUID": "x"}
+            )
+            check(response.status == 200, "report failed")
+            check(client.hedged_requests == 1, "non-idempotent request hedged")
+    finally:
+        await primary.stop()
+        await mirror.stop()
+
+
+@scenario("segments.revalidation")
+async def revalidation():
+    """An expired bucket is revalidated (If-None-Match, 304 Not Modified), and since the video's entry
+    didn't change its processed segments are reused instead of processing it again"""
+    vid_id = make_catalog(0, 1)[0]
+    (server,) = await start_servers(1, [vid_id])
+    try:
+        async with aiohttp.ClientSession() as web_session:
+            api_helper = make_api_helper(server, web_session)
+            processed = count_calls(api_helper, "process_segments")
+            segments = await api_helper.get_segments(vid_id)
+            check(segments and len(processed) == 1, "segments not fetched")
+
+            expire_buckets(api_helper)
+            revalidated = await api_helper.get_segments(vid_id)
+            check(server.segment_requests == 2, "expired bucket not requested again")
+            check(server.not_modified == 1, "bucket not revalidated")
+            check(len(processed) == 1, "unchanged entry processed again")
+            check(revalidated == segments, "revalidated segments differ")
+    finally:
+        await server.stop()
+
+
+@scenario("segments.adaptive_ttl")
+async def adaptive_ttl():
+    """Segments found again in a cached bucket keep their TTL, only refreshes that reached SponsorBlock
+    (here a 304) count as unchanged and make it longer, once per request even when several calls share
+    it"""
+    vid_id = make_catalog(0, 1)[0]
+    (server,) = await start_servers(1, [vid_id])
+    try:
+        async with aiohttp.ClientSession() as web_session:
+            api_helper = make_api_helper(server, web_session)
+            policy = api_helper.ttl_policy
+            await api_helper.get_segments(vid_id)
+            ttl = policy.history[vid_id][4]
+
+            for _ in range(3):  # The bucket is still fresh
+                api_helper.segments_cache.invalidate()
+                await api_helper.get_segments(vid_id)
+            check(server.segment_requests == 1, "fresh bucket requested again")
+            check(policy.refreshes == 0, "local bucket hits counted as refreshes")
+            check(policy.history[vid_id][4] == ttl, "TTL changed without a refresh")
+
+            expire_buckets(api_helper)
+            await api_helper.get_segments(vid_id)
+            check(server.not_modified == 1, "bucket not revalidated")
+            check(policy.refreshes == 1, "revalidation not counted as a refresh")
+            check(policy.history[vid_id][3] == 1, "unchanged refresh not counted")
+
+            expire_buckets(api_helper)
+            await asyncio.gather(*(api_helper.get_segments(vid_id) for _ in range(3)))
+            check(server.segment_requests == 3, "concurrent refreshes not shared")
+            check(policy.refreshes == 2, "shared refresh counted by every caller")
+    finally:
+        await server.stop()
+
+
+# Runner
+
+
+def run(names):
+    failures = 0
+    for name in names:
+        start = time.perf_counter()
+        try:
+            asyncio.run(SCENARIOS[name]())
+            result = "ok"
+        except ScenarioFailed as e:
+            failures += 1
+            result = f"FAIL: {e}"
+        print(f"{name:<40} {time.perf_counter() - start:>6.2f} s  {result}")
+    return failures
+
+
+def main_scenarios():
+    parser = argparse.ArgumentParser(description="SkipAdsTV failure scenarios")
+    parser.add_argument(
+        "--filter", default="", help="only run scenarios whose name contains this"
+    )
+    args = parser.parse_args()
+    if run([i for i in SCENARIOS if args.filter in i]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_scenarios()
@@ -0,0 +1,277 @@
+"""Fleet load test: runs the daemon (main.main, in this process) against local stand-ins for the lounge and
+SponsorBlock APIs (in a child process) with N virtual screens, and reports throughput, event-loop lag, RSS
+and skip accuracy for every fleet size:
+
+    python -m tools.simulator [--devices 1 10 100 1000] [--duration 60] [--json results.json]
+
+With --configs, every fleet size runs under each of the named runtime configurations (event loop and HTTP
+connector settings, see CONFIGURATIONS), to compare them on the same workload:
+
+    python -m tools.simulator --devices 100 200 --configs before asyncio uvloop
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import statistics
+import string
+import tempfile
+
+from SkipAdsTV import helpers, main, runtime
+
+from .fake_servers import FakeLounge, FakeScreen, FakeSponsorBlock
+
+CATALOG_SIZE = 500
+VIDEO_ID_ALPHABET = string.ascii_letters + string.digits + "-_"
+LAG_PROBE_INTERVAL = 0.1
+
+# Config options for each runtime configuration, on top of the defaults
+CONFIGURATIONS = {
+    "default": {},
+    # What main.main used before these options existed
+    "before": {
+        "event_loop": "asyncio",
+        "http_connection_limit": 100,
+        "http_keepalive_timeout": 15,
+    },
+    "asyncio": {"event_loop": "asyncio"},
+    "uvloop": {"event_loop": "uvloop"},
+}
+
+
+def make_catalog(seed, size=CATALOG_SIZE):
+    rng = random.Random(seed)
+    return ["".join(rng.choices(VIDEO_ID_ALPHABET, k=11)) for _ in range(size)]
+
+
+# Runs in the child process
+def serve(num_devices, seed, conn):
+    asyncio.run(_serve(num_devices, seed, conn))
+
+
+async def _serve(num_devices, seed, conn):
+    catalog = make_catalog(seed)
+    sponsorblock = FakeSponsorBlock()
+    for vid_id in catalog:
+        sponsorblock.add_video(vid_id)
+    screens = [
+        FakeScreen(f"screen-{i}", catalog, sponsorblock, seed)
+        for i in range(num_devices)
+    ]
+    lounge = FakeLounge(screens)
+    conn.send((await lounge.start(), await sponsorblock.start()))
+    await asyncio.get_running_loop().run_in_executor(None, conn.recv)  # Stop message
+    stats = [i.stats() for i in screens]
+    conn.send(
+        {
+            "events": sum(i["events"] for i in stats),
+            "commands": sum(i["commands"] for i in stats),
+            "expected": sum(i["expected"] for i in stats),
+            "skipped": sum(i["skipped"] for i in stats),
+            "errors": [j for i in stats for j in i["errors"]],
+            "ad_seconds": [j for i in stats for j in i["ad_seconds"]],
+            "segment_requests": sponsorblock.segment_requests,
+            "viewed_reports": len(sponsorblock.viewed_reports),
+        }
+    )
+    await lounge.stop()
+    await sponsorblock.stop()
+
+
+def current_rss():
+    """Resident set size in MiB"""
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_daemon(num_devices, lounge_api, sponsorblock_api, duration, options=None):
+    """Runs main.main for `duration` seconds, returns the loop lag samples, the peak RSS, the loop that
+    was used and the CPU time it took"""
+    with tempfile.TemporaryDirectory() as data_dir:
+        with open(os.path.join(data_dir, "config.json"), "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "devices": [
+                        {"screen_id": f"screen-{i}", "name": f"screen-{i}", "offset": 0}
+                        for i in range(num_devices)
+                    ],
+                    "lounge_api": lounge_api,
+                    "sponsorblock_apis": [sponsorblock_api],
+                    **(options or {}),
+                },
+                f,
+            )
+        config = helpers.Config(data_dir)
+        config.validate()
+
+        # The same loop main.main will use, so the probe runs on it
+        loop_implementation = runtime.install_event_loop_policy(config.event_loop)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        lags = []
+        rss = [current_rss()]
+
+        async def probe():
+            while True:
+                start = loop.time()
+                await asyncio.sleep(LAG_PROBE_INTERVAL)
+                lags.append(loop.time() - start - LAG_PROBE_INTERVAL)
+                if len(lags) % 10 == 0:
+                    rss.append(current_rss())
+
+        probe_task = loop.create_task(probe())
+
+        def stop():
+            probe_task.cancel()
+            rss.append(current_rss())
+            loop.stop()
+
+        loop.call_later(duration, stop)
+        start = cpu_time()
+        main.main(config, False)
+        cpu = cpu_time() - start
+    return lags, max(rss), loop_implementation, cpu
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def simulate(num_devices, duration, seed=0, configuration="default"):
+    context = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = context.Pipe()
+    server = context.Process(target=serve, args=(num_devices, seed, child_conn))
+    server.start()
+    try:
+        lounge_api, sponsorblock_api = parent_conn.recv()
+        lags, peak_rss, loop_implementation, cpu = run_daemon(
+            num_devices,
+            lounge_api,
+            sponsorblock_api,
+            duration,
+            CONFIGURATIONS[configuration],
+        )
+        parent_conn.send("stop")
+        fleet = parent_conn.recv()
+    finally:
+        server.join(10)
+        if server.is_alive():
+            server.kill()
+    errors = [abs(i) for i in fleet["errors"]]
+    return {
+        "devices": num_devices,
+        "configuration": configuration,
+        "event_loop": loop_implementation,
+        "duration": duration,
+        "events": fleet["events"],
+        "events_per_second": round(fleet["events"] / duration, 2),
+        "cpu_s": round(cpu, 3),
+        "cpu_us_per_event": (
+            round(cpu / fleet["events"] * 1e6, 1) if fleet["events"] else None
+        ),
+        "commands": fleet["commands"],
+        "segment_requests": fleet["segment_requests"],
+        "viewed_reports": fleet["viewed_reports"],
+        "loop_lag_ms": {
+            "mean": round(statistics.fmean(lags) * 1000, 3) if lags else 0.0,
+            "p99": round(percentile(lags, 0.99) * 1000, 3),
+            "max": round(max(lags, default=0.0) * 1000, 3),
+        },
+        "peak_rss_mb": round(peak_rss, 1),
+        "skips": {
+            "expected": fleet["expected"],
+            "skipped": fleet["skipped"],
+            "missed": fleet["expected"] - fleet["skipped"],
+            "accuracy": (
+                round(fleet["skipped"] / fleet["expected"], 4)
+                if fleet["expected"]
+                else None
+            ),
+            "mean_error_ms": (
+                round(statistics.fmean(errors) * 1000, 1) if errors else None
+            ),
+            "p95_error_ms": round(percentile(errors, 0.95) * 1000, 1),
+        },
+        # How long ads played after they could be skipped
+        "ads": {
+            "count": len(fleet["ad_seconds"]),
+            "mean_skippable_s": (
+                round(statistics.fmean(fleet["ad_seconds"]), 3)
+                if fleet["ad_seconds"]
+                else None
+            ),
+        },
+    }
+
+
+def print_results(results):
+    print(
+        f"{'config':<18} {'devices':>8} {'events/s':>9} {'CPU/event':>10} {'lag mean':>9}"
+        f" {'lag p99':>9} {'lag max':>9} {'RSS MiB':>8} {'skipped':>9} {'error p95':>10}"
+        f" {'ad wait':>9}"
+    )
+    for i in results:
+        lag, skips = i["loop_lag_ms"], i["skips"]
+        configuration = f"{i['configuration']} ({i['event_loop']})"
+        print(
+            f"{configuration:<18} {i['devices']:>8} {i['events_per_second']:>9}"
+            f" {i['cpu_us_per_event'] or 0:>8}us {lag['mean']:>7}ms"
+            f" {lag['p99']:>7}ms {lag['max']:>7}ms {i['peak_rss_mb']:>8}"
+            f" {skips['skipped']:>4}/{skips['expected']:<4} {skips['p95_error_ms']:>8}ms"
+            f" {i['ads']['mean_skippable_s'] or 0:>8}s"
+        )
+
+
+def main_simulator():
+    parser = argparse.ArgumentParser(description="SkipAdsTV fleet load test")
+    parser.add_argument(
+        "--devices", type=int, nargs="+", default=[1, 10, 100, 1000], help="fleet sizes"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=60, help="seconds to run every fleet size"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--configs",
+        nargs="+",
+        default=["default"],
+        choices=CONFIGURATIONS,
+        help="runtime configurations to compare",
+    )
+    parser.add_argument("--json", metavar="FILE", help="write the results to FILE")
+    args = parser.parse_args()
+
+    # Keep the output to the results: the daemon logs every device
+    logging.disable(logging.CRITICAL)  # The daemon's own logging is set up by main.main
+    results = []
+    for num_devices in args.devices:
+        for configuration in args.configs:
+            results.append(
+                simulate(num_devices, args.duration, args.seed, configuration)
+            )
+    print_results(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main_simulator()